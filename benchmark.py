@@ -0,0 +1,330 @@
+#Benchmark do App de Geolocalização Reversa
+#Sobe servidores locais que simulam o Nominatim e a API de municípios do IBGE
+#(num processo à parte) e mede o pipeline (MotorGeocodificacao) sobre arquivos sintéticos.
+
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import requests
+
+import geoapp
+
+
+# Área coberta pelos municípios sintéticos (aprox. o retângulo do Brasil), em células de 1 grau
+LAT_MIN, LAT_MAX = -34, 5  # dentro do retângulo do Brasil usado na validação
+LON_MIN, LON_MAX = -74, -34
+SIGLAS = sorted(geoapp.UFS)
+
+
+def municipio_da_celula(lat_celula, lon_celula):
+    """
+    Município sintético de uma célula de 1 grau: (codigo, nome, sigla da UF).
+    """
+    linha = lat_celula - LAT_MIN
+    coluna = lon_celula - LON_MIN
+    numero = linha * (LON_MAX - LON_MIN) + coluna
+    sigla = SIGLAS[numero % len(SIGLAS)]
+    return 1000000 + numero, f"Município {numero:04d}", sigla
+
+
+def municipios_ibge():
+    """
+    Lista de municípios no formato da API de localidades do IBGE.
+    """
+    municipios = []
+    for lat in range(LAT_MIN, LAT_MAX):
+        for lon in range(LON_MIN, LON_MAX):
+            codigo, nome, sigla = municipio_da_celula(lat, lon)
+            uf_id = SIGLAS.index(sigla) + 11
+            municipios.append({
+                "id": codigo,
+                "nome": nome,
+                "microrregiao": {"mesorregiao": {
+                    "id": uf_id * 100 + 1,
+                    "nome": f"Mesorregião {sigla}",
+                    "UF": {"id": uf_id, "sigla": sigla, "nome": geoapp.UFS[sigla]},
+                }},
+            })
+    return municipios
+
+
+def malha_sintetica():
+    """
+    Malha GeoJSON com um quadrado de 1 grau por município sintético (para o modo offline).
+    """
+    feicoes = []
+    for lat in range(LAT_MIN, LAT_MAX):
+        for lon in range(LON_MIN, LON_MAX):
+            codigo = municipio_da_celula(lat, lon)[0]
+            anel = [[lon, lat], [lon + 1, lat], [lon + 1, lat + 1], [lon, lat + 1], [lon, lat]]
+            feicoes.append({"type": "Feature", "properties": {"codarea": str(codigo)},
+                            "geometry": {"type": "Polygon", "coordinates": [anel]}})
+    return {"type": "FeatureCollection", "features": feicoes}
+
+
+class ServidorSimulado:
+    """
+    Servidor HTTP local com as rotas /reverse (Nominatim) e /municipios (IBGE).
+    Injeta latência, erros 500 e respostas 429 (com Retry-After) nas consultas ao Nominatim.
+    """
+
+    def __init__(self, latencia_ms=20.0, taxa_erro=0.0, taxa_429=0.0, semente=0, contador=None):
+        self.latencia = latencia_ms / 1000
+        self.taxa_erro = taxa_erro
+        self.taxa_429 = taxa_429
+        self.aleatorio = random.Random(semente)
+        self.requisicoes = 0
+        self.contador = contador  # multiprocessing.Value quando roda em outro processo
+        self.lock = threading.Lock()
+        self.corpo_municipios = json.dumps(municipios_ibge(), ensure_ascii=False).encode("utf-8")
+
+        servidor = self
+
+        class Manipulador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/municipios":
+                    self.responder(200, servidor.corpo_municipios)
+                elif url.path == "/reverse":
+                    servidor.reverse(self, parse_qs(url.query))
+                else:
+                    self.responder(404, b"{}")
+
+            def responder(self, status, corpo, cabecalhos=()):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(corpo)))
+                for nome, valor in cabecalhos:
+                    self.send_header(nome, valor)
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Manipulador)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def reverse(self, manipulador, params):
+        with self.lock:
+            self.requisicoes += 1
+            if self.contador is not None:
+                self.contador.value = self.requisicoes
+            sorteio = self.aleatorio.random()
+            atraso = self.latencia * (0.5 + self.aleatorio.random())
+        time.sleep(atraso)
+        if sorteio < self.taxa_429:
+            manipulador.responder(429, b"{}", [("Retry-After", "1")])
+            return
+        if sorteio < self.taxa_429 + self.taxa_erro:
+            manipulador.responder(500, b"{}")
+            return
+        lat = float(params["lat"][0])
+        lon = float(params["lon"][0])
+        lat_celula = int(np.floor(lat))
+        lon_celula = int(np.floor(lon))
+        if not (LAT_MIN <= lat_celula < LAT_MAX and LON_MIN <= lon_celula < LON_MAX):
+            manipulador.responder(200, b'{"error": "Unable to geocode"}')
+            return
+        _, nome, sigla = municipio_da_celula(lat_celula, lon_celula)
+        corpo = {"address": {"city": nome, "state": geoapp.UFS[sigla], "ISO3166-2-lvl4": f"BR-{sigla}"}}
+        manipulador.responder(200, json.dumps(corpo, ensure_ascii=False).encode("utf-8"))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _servir(parametros, conexao, contador):
+    with ServidorSimulado(*parametros, contador=contador) as servidor:
+        conexao.send(servidor.url)
+        conexao.recv()  # aguarda o pedido de parada
+
+
+class ServidorEmProcesso:
+    """
+    ServidorSimulado num processo separado, para que as threads do servidor não disputem
+    o GIL com os workers e a memória do servidor não entre no pico medido do pipeline.
+    """
+
+    def __init__(self, latencia_ms=20.0, taxa_erro=0.0, taxa_429=0.0, semente=0):
+        contexto = multiprocessing.get_context("spawn")
+        self.contador = contexto.Value("q", 0, lock=False)
+        self.conexao, filho = contexto.Pipe()
+        self.processo = contexto.Process(target=_servir, daemon=True,
+                                         args=((latencia_ms, taxa_erro, taxa_429, semente), filho, self.contador))
+        self.url = None
+
+    @property
+    def requisicoes(self):
+        return self.contador.value
+
+    def __enter__(self):
+        self.processo.start()
+        self.url = self.conexao.recv()
+        return self
+
+    def __exit__(self, *args):
+        self.conexao.send(None)
+        self.processo.join()
+
+
+def gerar_arquivo(pasta, linhas, duplicados, semente=0):
+    """
+    Gera (ou reaproveita) um CSV sintético com `linhas` linhas, em que a fração `duplicados`
+    das linhas repete coordenadas já presentes no arquivo.
+    """
+    caminho = os.path.join(pasta, f"entrada_{linhas}_{duplicados:g}_{semente}.csv")
+    if os.path.exists(caminho):
+        return caminho
+    rng = np.random.default_rng(semente)
+    unicos = max(1, int(round(linhas * (1 - duplicados))))
+    lat = np.round(rng.uniform(LAT_MIN, LAT_MAX, unicos), 6)
+    lon = np.round(rng.uniform(LON_MIN, LON_MAX, unicos), 6)
+    escolha = np.concatenate([np.arange(unicos), rng.integers(0, unicos, linhas - unicos)])
+    rng.shuffle(escolha)
+    df = pd.DataFrame({"id": np.arange(linhas), "latitude": lat[escolha], "longitude": lon[escolha]})
+    df.to_csv(caminho, index=False)
+    return caminho
+
+
+def pico_memoria_mb():
+    # ru_maxrss é em KB no Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def executar_cenario(cenario, pasta_dados):
+    """
+    Executa um cenário num processo isolado (para medir o pico de memória de cada um).
+    """
+    entrada = gerar_arquivo(pasta_dados, cenario["linhas"], cenario["duplicados"])
+    latencias = []
+    get_original = requests.Session.get
+
+    def get_cronometrado(sessao, url, *args, **kwargs):
+        # Só a chamada HTTP ao Nominatim entra nos percentis (sem a espera do limitador)
+        inicio = time.perf_counter()
+        try:
+            return get_original(sessao, url, *args, **kwargs)
+        finally:
+            if url.endswith("/reverse"):
+                latencias.append(time.perf_counter() - inicio)
+
+    requests.Session.get = get_cronometrado
+
+    with ServidorEmProcesso(cenario["latencia_ms"], cenario["taxa_erro"], cenario["taxa_429"]) as servidor, \
+            tempfile.TemporaryDirectory() as pasta, \
+            open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+        pasta_temp = os.path.join(pasta, "temp")
+        if cenario["modo"] == "offline":
+            os.makedirs(pasta_temp)
+            with open(os.path.join(pasta_temp, "malha_sintetica.geojson"), "w", encoding="utf-8") as f:
+                json.dump(malha_sintetica(), f)
+
+        configs = dict(geoapp.DEFAULT_CONFIGS)
+        configs.update({
+            "input_csv": entrada,
+            "output": os.path.join(pasta, "saida"),
+            "formato_saida": cenario["formato"],
+            "pasta_temp": pasta_temp,
+            "api_ibge_url": servidor.url + "/municipios",
+            "api_nominatim_url": servidor.url + "/reverse",
+            "modo_geocodificacao": cenario["modo"],
+            "requisicoes_por_segundo": str(cenario["taxa"]),
+            "rajada": str(cenario["workers"]),
+            "workers": str(cenario["workers"]),
+            "modo_streaming": "1" if cenario["streaming"] else "0",
+        })
+        mensagens = []
+        motor = geoapp.MotorGeocodificacao(configs, ao_log=mensagens.append, ao_erro=mensagens.append)
+        inicio = time.perf_counter()
+        concluido = motor.executar()
+        duracao = time.perf_counter() - inicio
+
+    latencias_ms = np.array(latencias) * 1000
+    return dict(
+        cenario,
+        concluido=concluido,
+        segundos=round(duracao, 3),
+        linhas_por_segundo=round(cenario["linhas"] / duracao, 1),
+        requisicoes=servidor.requisicoes,
+        latencia_p50_ms=round(float(np.percentile(latencias_ms, 50)), 2) if len(latencias_ms) else None,
+        latencia_p99_ms=round(float(np.percentile(latencias_ms, 99)), 2) if len(latencias_ms) else None,
+        pico_memoria_mb=round(pico_memoria_mb(), 1),
+    )
+
+
+def _processo_cenario(cenario, pasta_dados, fila):
+    try:
+        fila.put(executar_cenario(cenario, pasta_dados))
+    except Exception as e:
+        fila.put(dict(cenario, erro=str(e)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline de geocodificação com APIs simuladas.")
+    parser.add_argument("--linhas", type=int, nargs="+", default=[10_000], help="linhas por arquivo (ex.: 10000 1000000)")
+    parser.add_argument("--duplicados", type=float, nargs="+", default=[0.5], help="fração de linhas repetidas")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--modo", nargs="+", choices=["nominatim", "offline"], default=["nominatim"])
+    parser.add_argument("--formato", default="csv", choices=geoapp.FORMATOS_SAIDA)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--latencia-ms", type=float, default=20.0, help="latência média simulada do Nominatim")
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="fração de respostas 500")
+    parser.add_argument("--taxa-429", type=float, default=0.0, help="fração de respostas 429")
+    parser.add_argument("--taxa", type=float, default=10_000.0, help="requisições por segundo do limitador")
+    parser.add_argument("--dados", default=os.path.join(tempfile.gettempdir(), "geoapp_benchmark"),
+                        help="pasta onde os arquivos sintéticos são gerados e reaproveitados")
+    parser.add_argument("--relatorio", help="grava os resultados em JSON neste arquivo")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.dados, exist_ok=True)
+    resultados = []
+    contexto = multiprocessing.get_context("spawn")
+    for linhas, duplicados, workers, modo in itertools.product(args.linhas, args.duplicados, args.workers, args.modo):
+        cenario = dict(linhas=linhas, duplicados=duplicados, workers=workers, modo=modo, formato=args.formato,
+                       streaming=args.streaming, latencia_ms=args.latencia_ms, taxa_erro=args.taxa_erro,
+                       taxa_429=args.taxa_429, taxa=args.taxa)
+        fila = contexto.Queue()
+        processo = contexto.Process(target=_processo_cenario, args=(cenario, args.dados, fila))
+        processo.start()
+        resultado = fila.get()
+        processo.join()
+        resultados.append(resultado)
+        if "erro" in resultado:
+            print(f"{modo:<9} linhas={linhas:<9} dup={duplicados:<4} workers={workers:<3} ERRO: {resultado['erro']}")
+            continue
+        print(f"{modo:<9} linhas={linhas:<9} dup={duplicados:<4} workers={workers:<3} "
+              f"{resultado['linhas_por_segundo']:>10} linhas/s  "
+              f"p50={resultado['latencia_p50_ms'] or '-'}ms p99={resultado['latencia_p99_ms'] or '-'}ms  "
+              f"req={resultado['requisicoes']}  mem={resultado['pico_memoria_mb']}MB", flush=True)
+
+    if args.relatorio:
+        with open(args.relatorio, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,41 +4,115 @@
 
 
 
+import argparse
+import importlib.util
 import os
+import queue
+import sys
 import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import chain
 import time
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-import pandas as pd
-import requests
+INICIO_PROGRAMA = time.perf_counter()  # referência do tempo até a janela abrir
 import configparser
-import sqlite3
+import json
+import math
+import random
 import unicodedata
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# A interface é opcional: sem o Tk (servidores sem python3-tk) a linha de comando continua funcionando
+try:
+    import tkinter as tk
+    from tkinter import ttk, messagebox, filedialog
+    JanelaBase = tk.Tk
+except ImportError:
+    tk = ttk = messagebox = filedialog = None
+    JanelaBase = object
+
+
+def importar_tardio(nome):
+    """
+    Importa o módulo só no primeiro acesso a um atributo, para que a janela abra sem
+    esperar pelo pandas/numpy/requests.
+    """
+    if nome in sys.modules:
+        return sys.modules[nome]
+    spec = importlib.util.find_spec(nome)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules[nome] = modulo
+    loader.exec_module(modulo)
+    return modulo
+
+
+np = importar_tardio("numpy")
+pd = importar_tardio("pandas")
+requests = importar_tardio("requests")
+sqlite3 = importar_tardio("sqlite3")
+
+
+def carregar_modulos_tardios():
+    # Qualquer acesso a atributo conclui a importação tardia
+    for modulo in (np, pd, requests, sqlite3):
+        getattr(modulo, "__file__", None)
 
 
 URL_IBGE = "https://servicodados.ibge.gov.br/api/v1/localidades/municipios"
 URL_NOMINATIM = "https://nominatim.openstreetmap.org/reverse"
+URL_MALHAS = "https://servicodados.ibge.gov.br/api/v3/malhas/paises/BR"
 
 DEFAULT_CONFIGS = {
     "pasta_temp": "malhas_ibge",
     "input": "",
     "output": "coordenadas_com_ibge",
-    "batch_size": "10",
-    "delay_segundos": "1.5",
+    "requisicoes_por_segundo": "1",
+    "rajada": "1",
+    "workers": "1",
+    "timeout_segundos": "10",
+    "retentativas": "3",
+    "retentativa_espera_segundos": "5",
+    "disjuntor_falhas": "5",
+    "disjuntor_segundos": "30",
+    "trabalhos_paralelos": "1",
     "user_agent": "MeuAppGeocodificacao/1.0 (contato@exemplo.com)",
     "formato_saida": "xlsx",
+    "ibge_ttl_horas": "168",
+    "cache_precisao": "5",
+    "cache_max_entradas": "1000000",
+    "cache_ttl_dias": "0",
+    "modo_geocodificacao": "nominatim",
+    "api_malhas_url": URL_MALHAS,
+    "precisao_coordenadas": "",
+    "modo_streaming": "0",
+    "tamanho_parte": "50000",
+    "checkpoint_segundos": "15",
+    "log_por_linha": "0",
+    "ordem_espacial": "0",
+    "reuso_celula_casas": "",
+    "metricas_arquivo": "",
+    "metricas_segundos": "30",
+    "saida_anterior": "",
+    "chave_incremental": "",
+    "validacao_coordenadas": "marcar",
+    "corrigir_invertidas": "0",
 }
 
 CONFIG_FILE = ".conf"
 
-def load_configs():
+def load_configs(caminho=CONFIG_FILE):
     config = configparser.ConfigParser()
-    if os.path.exists(CONFIG_FILE):
-        config.read(CONFIG_FILE)
+    if os.path.exists(caminho):
+        config.read(caminho)
         if 'CONFIGS' in config:
             cfgs = dict(config['CONFIGS'])
-            if 'formato_saida' not in cfgs:
-                cfgs['formato_saida'] = DEFAULT_CONFIGS['formato_saida']
+            for chave, valor in DEFAULT_CONFIGS.items():
+                cfgs.setdefault(chave, valor)
             return cfgs
     return DEFAULT_CONFIGS.copy()
 
@@ -48,6 +122,15 @@ def save_configs(configs):
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         config.write(f)
 
+def config_numero(configs, chave, tipo=float):
+    """
+    Lê uma configuração numérica, voltando ao valor padrão se estiver ausente ou inválida.
+    """
+    try:
+        return tipo(configs.get(chave, DEFAULT_CONFIGS[chave]))
+    except (TypeError, ValueError):
+        return tipo(DEFAULT_CONFIGS[chave])
+
 
 def normalizar(texto):
     """
@@ -57,11 +140,229 @@ def normalizar(texto):
         return ""
     return unicodedata.normalize('NFKD', texto).encode('ASCII', 'ignore').decode('utf-8').lower()
 
-import requests
+class LimitadorTaxa:
+    """
+    Limitador de taxa (token bucket) compartilhado por todas as requisições HTTP.
+    Permite até `rajada` requisições seguidas e repõe fichas a `taxa` por segundo.
+    Ao receber 429/503 reduz a taxa pela metade e respeita o Retry-After; a cada
+    resposta bem-sucedida a taxa volta aos poucos ao valor configurado.
+    """
+
+    def __init__(self, taxa=1.0, rajada=1, cancelar=None):
+        self.taxa_maxima = max(float(taxa), 0.01)
+        self.taxa = self.taxa_maxima
+        self.taxa_minima = self.taxa_maxima / 16
+        self.rajada = max(int(rajada), 1)
+        self.fichas = float(self.rajada)
+        self.cancelar = cancelar  # threading.Event que interrompe a espera
+        self.rejeicoes = 0
+        self.espera_total = 0.0  # segundos aguardando fichas (métricas)
+        self._ultimo = time.monotonic()
+        self._bloqueado_ate = 0.0
+        self.lock = threading.Lock()
+
+    def _repor(self, agora):
+        self.fichas = min(self.rajada, self.fichas + (agora - self._ultimo) * self.taxa)
+        self._ultimo = agora
+
+    def adquirir(self):
+        """
+        Aguarda uma ficha disponível. Retorna False se a espera foi cancelada.
+        """
+        inicio = time.monotonic()
+        while True:
+            with self.lock:
+                agora = time.monotonic()
+                self._repor(agora)
+                espera = self._bloqueado_ate - agora
+                if espera <= 0 and self.fichas >= 1:
+                    self.fichas -= 1
+                    self.espera_total += agora - inicio
+                    return True
+                espera = max(espera, (1 - self.fichas) / self.taxa)
+            if self.cancelar is not None and self.cancelar.is_set():
+                return False
+            time.sleep(min(espera, 0.1))
+
+    def registrar_rejeicao(self, retry_after=None):
+        with self.lock:
+            agora = time.monotonic()
+            self._repor(agora)
+            self.rejeicoes += 1
+            self.taxa = max(self.taxa_minima, self.taxa / 2)
+            self.fichas = 0.0
+            if retry_after:
+                self._bloqueado_ate = max(self._bloqueado_ate, agora + retry_after)
+
+    def registrar_sucesso(self):
+        with self.lock:
+            if self.taxa < self.taxa_maxima:
+                self._repor(time.monotonic())
+                self.taxa = min(self.taxa_maxima, self.taxa + self.taxa_maxima * 0.05)
+
+
+def segundos_retry_after(valor):
+    """
+    Converte o cabeçalho Retry-After (segundos ou data HTTP) em segundos de espera.
+    """
+    if not valor:
+        return None
+    try:
+        return max(float(valor), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(valor).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def criar_sessao(conexoes=1):
+    """
+    Cria uma sessão HTTP com conexões keep-alive reaproveitadas entre as requisições.
+    """
+    sessao = requests.Session()
+    adaptador = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(conexoes, 1))
+    sessao.mount("http://", adaptador)
+    sessao.mount("https://", adaptador)
+    return sessao
+
+
+_sessao_aquecida = None  # (conexoes, sessão) aberta pelo aquecimento
+_lock_sessao = threading.Lock()
+
+
+def obter_sessao(conexoes=1):
+    """
+    Entrega a sessão aberta pelo aquecimento (com a conexão já estabelecida) ou cria uma nova.
+    """
+    global _sessao_aquecida
+    with _lock_sessao:
+        aquecida, _sessao_aquecida = _sessao_aquecida, None
+    if aquecida is not None:
+        tamanho, sessao = aquecida
+        if tamanho == max(conexoes, 1):
+            return sessao
+        sessao.close()
+    return criar_sessao(conexoes)
+
+
+class CircuitoAberto(Exception):
+    """
+    O endpoint está suspenso pelo disjuntor depois de falhas seguidas.
+    """
+
+
+class Disjuntor:
+    """
+    Disjuntor (circuit breaker) de um endpoint: após `limite_falhas` falhas seguidas (erro de
+    conexão, timeout ou 5xx) as requisições são recusadas na hora, sem esperar timeouts.
+    Enquanto aberto, deixa passar uma requisição de teste a cada `segundos`; se ela der certo
+    o circuito fecha e o tráfego volta ao normal.
+    """
+
+    def __init__(self, nome, limite_falhas=5, segundos=30.0):
+        self.nome = nome
+        self.limite_falhas = max(int(limite_falhas), 1)
+        self.segundos = max(float(segundos), 0.0)
+        self.falhas_seguidas = 0
+        self.aberturas = 0
+        self.aberto = False
+        self._liberado_em = 0.0
+        self.lock = threading.Lock()
+
+    def permitir(self):
+        with self.lock:
+            if not self.aberto:
+                return True
+            agora = time.monotonic()
+            if agora >= self._liberado_em:
+                self._liberado_em = agora + self.segundos  # uma requisição de teste por intervalo
+                return True
+            return False
+
+    def segundos_ate_liberar(self):
+        with self.lock:
+            return max(self._liberado_em - time.monotonic(), 0.0) if self.aberto else 0.0
+
+    def registrar_sucesso(self):
+        with self.lock:
+            if self.aberto:
+                print(f"[AVISO] {self.nome} voltou a responder; requisições retomadas.")
+            self.aberto = False
+            self.falhas_seguidas = 0
+
+    def registrar_falha(self):
+        with self.lock:
+            self.falhas_seguidas += 1
+            if self.aberto:
+                self._liberado_em = time.monotonic() + self.segundos
+            elif self.falhas_seguidas >= self.limite_falhas:
+                self.aberto = True
+                self.aberturas += 1
+                self._liberado_em = time.monotonic() + self.segundos
+                print(f"[AVISO] {self.nome}: {self.falhas_seguidas} falhas seguidas; "
+                      f"requisições suspensas por {self.segundos:g}s.")
+
+
+_disjuntores = {}
+_lock_disjuntores = threading.Lock()
+
+
+def obter_disjuntor(url, limite_falhas=5, segundos=30.0):
+    """
+    Disjuntor compartilhado por todas as requisições ao mesmo endpoint (host) na execução.
+    """
+    host = urlparse(url).netloc or url
+    with _lock_disjuntores:
+        disjuntor = _disjuntores.get(host)
+        if disjuntor is None:
+            disjuntor = _disjuntores[host] = Disjuntor(host, limite_falhas, segundos)
+        else:
+            disjuntor.limite_falhas = max(int(limite_falhas), 1)
+            disjuntor.segundos = max(float(segundos), 0.0)
+        return disjuntor
+
+
+def requisicao_get(url, limitador=None, tentativas=3, sessao=None, disjuntor=None, **kwargs):
+    """
+    GET passando pelo limitador de taxa. Respostas 429/503 reduzem a taxa do limitador
+    e a requisição é repetida até o número de tentativas. Com um disjuntor, erros de
+    conexão, timeouts e respostas 5xx contam como falhas do endpoint.
+    """
+    if disjuntor is not None and not disjuntor.permitir():
+        raise CircuitoAberto(f"{disjuntor.nome} suspenso após falhas seguidas.")
+    for tentativa in range(tentativas):
+        if limitador is not None and not limitador.adquirir():
+            raise InterruptedError("Requisição cancelada.")
+        try:
+            response = (sessao or requests).get(url, **kwargs)
+        except requests.RequestException:
+            if disjuntor is not None:
+                disjuntor.registrar_falha()
+            raise
+        if response.status_code in (429, 503) and limitador is not None:
+            limitador.registrar_rejeicao(segundos_retry_after(response.headers.get("Retry-After")))
+            print(f"[AVISO] {url} respondeu {response.status_code}; "
+                  f"taxa reduzida para {limitador.taxa:.2f} req/s.")
+            if tentativa < tentativas - 1:
+                continue
+        if response.status_code >= 500 and disjuntor is not None:
+            disjuntor.registrar_falha()
+        response.raise_for_status()
+        if limitador is not None:
+            limitador.registrar_sucesso()
+        if disjuntor is not None:
+            disjuntor.registrar_sucesso()
+        return response
+
 
-def geocodificar_reversa(latitude, longitude, user_agent, url_nominatim=URL_NOMINATIM):
+def geocodificar_reversa(latitude, longitude, user_agent, url_nominatim=URL_NOMINATIM, limitador=None,
+                         sessao=None, disjuntor=None, timeout=10):
     """
     Realiza a geocodificação reversa usando o Nominatim e retorna um dicionário com os componentes do endereço.
+    Retorna None em caso de erro (a coordenada pode ser tentada de novo) e {} se não há endereço.
+    CircuitoAberto é repassada: a requisição nem chegou a ser enviada.
     """
     try:
         headers = {"User-Agent": user_agent}
@@ -75,58 +376,2339 @@ def geocodificar_reversa(latitude, longitude, user_agent, url_nominatim=URL_NOMI
             "accept-language": "pt-BR"
         }
 
-        response = requests.get(url_nominatim, headers=headers, params=params, timeout=10)
-        response.raise_for_status()
+        response = requisicao_get(url_nominatim, limitador, sessao=sessao, disjuntor=disjuntor,
+                                  headers=headers, params=params, timeout=timeout)
         data = response.json()
         endereco = data.get("address", {})
         return endereco
 
+    except CircuitoAberto:
+        raise
     except Exception as e:
         print(f"[ERRO] Geocodificação reversa falhou para ({latitude}, {longitude}): {e}")
         return None
 
-def buscar_dados_ibge(cidade, uf_sigla, url_ibge=URL_IBGE):
+UFS = {
+    "AC": "Acre", "AL": "Alagoas", "AP": "Amapá", "AM": "Amazonas", "BA": "Bahia",
+    "CE": "Ceará", "DF": "Distrito Federal", "ES": "Espírito Santo", "GO": "Goiás",
+    "MA": "Maranhão", "MT": "Mato Grosso", "MS": "Mato Grosso do Sul", "MG": "Minas Gerais",
+    "PA": "Pará", "PB": "Paraíba", "PR": "Paraná", "PE": "Pernambuco", "PI": "Piauí",
+    "RJ": "Rio de Janeiro", "RN": "Rio Grande do Norte", "RS": "Rio Grande do Sul",
+    "RO": "Rondônia", "RR": "Roraima", "SC": "Santa Catarina", "SP": "São Paulo",
+    "SE": "Sergipe", "TO": "Tocantins",
+}
+
+# Nome do estado normalizado -> sigla da UF
+UF_POR_NOME = {normalizar(nome): sigla for sigla, nome in UFS.items()}
+
+DADOS_IBGE_VAZIOS = ("", "", "", "", "", "", "")
+COLUNAS_IBGE = ["municipio_ibge", "codigo_ibge", "mesorregiao", "codigo_mesorregiao",
+                "uf_nome", "uf_codigo", "uf_sigla"]
+COLUNAS_ENRIQUECIMENTO = ["cidade", "estado"] + COLUNAS_IBGE
+# Códigos viram inteiros anuláveis (Int64); os textos, categorias (poucos valores distintos)
+COLUNAS_INTEIRAS = ["codigo_ibge", "codigo_mesorregiao", "uf_codigo"]
+
+
+def sigla_uf(estado):
+    """
+    Converte o estado retornado pelo Nominatim (sigla, "BR-SP" ou nome completo) na sigla da UF.
+    Retorna "" quando não for possível identificar a UF.
+    """
+    if not estado:
+        return ""
+    estado = str(estado).strip()
+    if estado.upper().startswith("BR-"):
+        estado = estado[3:]
+    if estado.upper() in UFS:
+        return estado.upper()
+    return UF_POR_NOME.get(normalizar(estado).strip(), "")
+
+
+class IndiceMunicipios:
+    """
+    Índice em memória dos municípios do IBGE, chaveado por (nome normalizado, sigla da UF).
+    A lista é baixada uma única vez e guardada em disco na pasta temporária, sendo
+    renovada quando fica mais velha que a validade configurada.
+    """
+
+    ARQUIVO_CACHE = "municipios_ibge.json"
+
+    def __init__(self, registros):
+        # registro: (codigo_ibge, nome, codigo_mesorregiao, mesorregiao, uf_codigo, uf_sigla, uf_nome)
+        self.por_nome = {}
+        self.por_codigo = {}
+        self._tabela = None
+        for codigo, nome, cod_meso, meso, uf_codigo, uf_sigla, uf_nome in registros:
+            dados = (nome, codigo, meso, cod_meso, uf_nome, uf_codigo, uf_sigla)
+            self.por_nome[(normalizar(nome).strip(), uf_sigla)] = dados
+            self.por_codigo[codigo] = dados
+
+    def __len__(self):
+        return len(self.por_codigo)
+
+    def como_dataframe(self):
+        """
+        Tabela dos municípios com as chaves de junção (_nome normalizado, _uf) e as colunas IBGE.
+        """
+        if self._tabela is None:
+            linhas = [(nome, uf) + dados for (nome, uf), dados in self.por_nome.items()]
+            self._tabela = pd.DataFrame(linhas, columns=["_nome", "_uf"] + COLUNAS_IBGE).astype(object)
+        return self._tabela
+
+    def buscar(self, cidade, estado):
+        """
+        Retorna a tupla de dados IBGE do município, ou DADOS_IBGE_VAZIOS se não encontrado.
+        """
+        uf = sigla_uf(estado)
+        if not cidade or not uf:
+            return DADOS_IBGE_VAZIOS
+        return self.por_nome.get((normalizar(cidade).strip(), uf), DADOS_IBGE_VAZIOS)
+
+    @staticmethod
+    def _extrair_registro(municipio):
+        micro = municipio.get("microrregiao") or {}
+        meso = micro.get("mesorregiao") or {}
+        uf = meso.get("UF")
+        if not uf:
+            # Municípios recentes podem vir sem microrregião; usa a região imediata.
+            imediata = municipio.get("regiao-imediata") or {}
+            uf = (imediata.get("regiao-intermediaria") or {}).get("UF") or {}
+        return (municipio["id"], municipio["nome"], meso.get("id", ""), meso.get("nome", ""),
+                uf.get("id", ""), uf.get("sigla", ""), uf.get("nome", ""))
+
+    @classmethod
+    def baixar(cls, url_ibge=URL_IBGE, limitador=None):
+        response = requisicao_get(url_ibge, limitador, timeout=25)
+        return [cls._extrair_registro(m) for m in response.json()]
+
+    @classmethod
+    def carregar(cls, url_ibge=URL_IBGE, pasta_temp=DEFAULT_CONFIGS["pasta_temp"],
+                 ttl_horas=float(DEFAULT_CONFIGS["ibge_ttl_horas"]), limitador=None):
+        """
+        Carrega o índice do cache em disco se ainda estiver válido; caso contrário baixa a
+        lista do IBGE e atualiza o cache. Sem rede, usa o cache mesmo que expirado.
+        """
+        caminho = os.path.join(pasta_temp or ".", cls.ARQUIVO_CACHE)
+        cache = None
+        if os.path.exists(caminho):
+            try:
+                with open(caminho, "r", encoding="utf-8") as f:
+                    cache = json.load(f)
+            except Exception as e:
+                print(f"[ERRO] Lendo cache de municípios {caminho}: {e}")
+
+        if cache and cache.get("url") == url_ibge:
+            idade_horas = (time.time() - cache.get("gerado_em", 0)) / 3600
+            if ttl_horas <= 0 or idade_horas < ttl_horas:
+                return cls(cache["municipios"])
+
+        try:
+            registros = cls.baixar(url_ibge, limitador)
+        except Exception as e:
+            if cache:
+                print(f"[ERRO] Atualizando municípios do IBGE, usando cache expirado: {e}")
+                return cls(cache["municipios"])
+            raise
+
+        try:
+            os.makedirs(pasta_temp or ".", exist_ok=True)
+            with open(caminho, "w", encoding="utf-8") as f:
+                json.dump({"url": url_ibge, "gerado_em": time.time(), "municipios": registros},
+                          f, ensure_ascii=False)
+        except Exception as e:
+            print(f"[ERRO] Salvando cache de municípios {caminho}: {e}")
+        return cls(registros)
+
+
+_indices_municipios = {}
+_lock_indices = threading.Lock()
+
+
+def obter_indice_municipios(url_ibge=URL_IBGE, pasta_temp=DEFAULT_CONFIGS["pasta_temp"],
+                            ttl_horas=float(DEFAULT_CONFIGS["ibge_ttl_horas"]), limitador=None):
+    """
+    Retorna o índice de municípios da execução, carregando-o apenas na primeira chamada.
+    """
+    with _lock_indices:
+        indice = _indices_municipios.get(url_ibge)
+        if indice is None:
+            indice = IndiceMunicipios.carregar(url_ibge, pasta_temp, ttl_horas, limitador)
+            _indices_municipios[url_ibge] = indice
+        return indice
+
+
+def buscar_dados_ibge(cidade, uf_sigla, url_ibge=URL_IBGE, pasta_temp=DEFAULT_CONFIGS["pasta_temp"],
+                      ttl_horas=float(DEFAULT_CONFIGS["ibge_ttl_horas"]), limitador=None):
     """
     Busca os dados do município no IBGE, retornando nome, código IBGE, mesorregião e UF.
-    Faz comparação com nomes normalizados (sem acentos e em minúsculas).
+    A UF pode ser a sigla ou o nome completo do estado. A consulta é feita no índice em
+    memória, com nomes normalizados (sem acentos e em minúsculas).
     """
     try:
-        response = requests.get(url_ibge, timeout=25)
-        response.raise_for_status()
-        municipios = response.json()
+        indice = obter_indice_municipios(url_ibge, pasta_temp, ttl_horas, limitador)
+        return indice.buscar(cidade, uf_sigla)
+
+    except Exception as e:
+        print(f"[ERRO] Buscando dados IBGE: {e}")
+        return DADOS_IBGE_VAZIOS
+
+def chaves_coordenadas(df, precisao=None, validas=None):
+    """
+    Calcula a chave (latitude, longitude) de cada linha, arredondada na precisão indicada.
+    Retorna as chaves por linha e as chaves únicas válidas, que são as únicas geocodificadas.
+    Linhas fora da máscara `validas` ficam sem chave, como as linhas sem coordenadas.
+    """
+    latitudes = pd.to_numeric(df["latitude"], errors="coerce")
+    longitudes = pd.to_numeric(df["longitude"], errors="coerce")
+    if precisao is not None:
+        latitudes = latitudes.round(precisao)
+        longitudes = longitudes.round(precisao)
+    if validas is not None:
+        latitudes = latitudes.where(validas)
+        longitudes = longitudes.where(validas)
+    chaves = pd.DataFrame({"_lat": latitudes, "_lon": longitudes}, index=df.index)
+    unicos = chaves.dropna().drop_duplicates().reset_index(drop=True)
+    return chaves, unicos
+
+
+def indice_hilbert(latitudes, longitudes, ordem=16):
+    """
+    Posição de cada coordenada ao longo de uma curva de Hilbert numa grade de 2^ordem x 2^ordem
+    sobre o globo. Pontos próximos no mapa ficam próximos na ordenação por esse índice.
+    """
+    n = 1 << ordem
+    x = np.clip(((np.asarray(longitudes, dtype=float) + 180) / 360 * n).astype(np.int64), 0, n - 1)
+    y = np.clip(((np.asarray(latitudes, dtype=float) + 90) / 180 * n).astype(np.int64), 0, n - 1)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # Rotaciona o quadrante para que a curva continue contígua
+        inverter = ~ry & rx
+        x = np.where(inverter, n - 1 - x, x)
+        y = np.where(inverter, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return d
+
+
+def ordenar_espacialmente(unicos):
+    """
+    Ordena as coordenadas únicas ao longo da curva de Hilbert (vizinhas são geocodificadas em sequência).
+    """
+    if len(unicos) < 2:
+        return unicos
+    ordem = np.argsort(indice_hilbert(unicos["_lat"].to_numpy(), unicos["_lon"].to_numpy()), kind="stable")
+    return unicos.iloc[ordem].reset_index(drop=True)
+
+
+def normalizar_serie(serie):
+    """
+    Versão vetorizada de normalizar() para uma Series de textos.
+    """
+    return (serie.fillna("").astype(str).str.normalize("NFKD")
+            .str.encode("ascii", "ignore").str.decode("utf-8").str.lower().str.strip())
+
+
+def aplicar_resultados(df, chaves, resultados, indice=None):
+    """
+    Monta as colunas de enriquecimento da parte em bloco: os resultados das coordenadas
+    únicas viram colunas, os dados do IBGE entram num único merge por (cidade, UF) e o
+    resultado é replicado para todas as linhas com a mesma chave. Os textos ficam como
+    categorias e os códigos como Int64; linhas sem resultado ficam com valores ausentes.
+    `resultados` mapeia (lat, lon) -> (cidade, estado, uf).
+    Retorna quantas coordenadas com cidade não foram encontradas no índice do IBGE.
+    """
+    unicos = chaves.dropna().drop_duplicates()
+    latitudes, longitudes, cidades, estados, ufs = [], [], [], [], []
+    for chave in zip(unicos["_lat"], unicos["_lon"]):
+        resultado = resultados.get(chave)
+        if resultado is not None:
+            latitudes.append(chave[0])
+            longitudes.append(chave[1])
+            cidades.append(resultado[0])
+            estados.append(resultado[1])
+            ufs.append(resultado[2])
+
+    tabela = pd.DataFrame({"_lat": latitudes, "_lon": longitudes,
+                           "cidade": pd.Series(cidades, dtype=object),
+                           "estado": pd.Series(estados, dtype=object),
+                           "_uf": pd.Series(ufs, dtype=object)})
+    sem_ibge = 0
+    if indice is not None:
+        tabela["_nome"] = normalizar_serie(tabela["cidade"])
+        tabela = tabela.merge(indice.como_dataframe(), on=["_nome", "_uf"], how="left")
+        sem_ibge = int((tabela["codigo_ibge"].isna() & (tabela["_nome"] != "")).sum())
+
+    # Posição de cada linha na tabela de coordenadas únicas (-1 = sem resultado)
+    posicoes = chaves.merge(tabela[["_lat", "_lon"]].assign(_pos=np.arange(len(tabela))),
+                            on=["_lat", "_lon"], how="left")["_pos"]
+    posicoes = posicoes.fillna(-1).to_numpy(dtype=np.int64)
+    for col in COLUNAS_ENRIQUECIMENTO:
+        valores = tabela[col] if col in tabela else pd.Series(np.nan, index=tabela.index, dtype=object)
+        if col in COLUNAS_INTEIRAS:
+            inteiros = pd.to_numeric(valores, errors="coerce").astype("Int64").array
+            df[col] = inteiros.take(posicoes, allow_fill=True)
+        else:
+            codigos, categorias = pd.factorize(valores.astype(object))
+            codigos = np.append(codigos, -1)[posicoes]  # posição -1 pega o código ausente
+            df[col] = pd.Categorical.from_codes(codigos, categories=categorias.astype(object))
+    return sem_ibge
+
+
+LIMITE_RESULTADOS_MEMORIA = 1_000_000  # coordenadas mantidas em memória no modo streaming
+
+
+def importar_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Os formatos Parquet e Feather precisam do pacote pyarrow (pip install pyarrow).")
+    return pyarrow
 
-        cidade_normalizada = normalizar(cidade)
-        uf_sigla_normalizada = normalizar(uf_sigla)
 
-        for municipio in municipios:
-            nome_mun = normalizar(municipio["nome"])
-            uf = municipio["microrregiao"]["mesorregiao"]["UF"]
-            sigla_uf_api = normalizar(uf["sigla"])
+COLUNAS_COORDENADAS = ["latitude", "longitude"]
+EXTENSOES_ENTRADA = (".csv", ".xlsx", ".parquet", ".feather", ".arrow")
 
-            if nome_mun == cidade_normalizada and sigla_uf_api == uf_sigla_normalizada:
-                municipio_ibge = municipio["nome"]
-                codigo_ibge = municipio["id"]
-                mesorregiao = municipio["microrregiao"]["mesorregiao"]["nome"]
-                codigo_mesorregiao = municipio["microrregiao"]["mesorregiao"]["id"]
-                uf_nome = uf["nome"]
-                uf_codigo = uf["id"]
-                uf_sigla = uf["sigla"]
 
-                return (municipio_ibge, codigo_ibge, mesorregiao, codigo_mesorregiao,
-                        uf_nome, uf_codigo, uf_sigla)
+def extensao_entrada(caminho):
+    extensao = os.path.splitext(caminho)[1].lower()
+    if extensao not in EXTENSOES_ENTRADA:
+        raise ValueError("Formato de arquivo não suportado.")
+    return extensao
 
-        return ("", "", "", "", "", "", "")
 
+def abrir_arrow(caminho):
+    """
+    Abre um arquivo Feather/Arrow IPC mapeado em memória (a leitura não copia os dados).
+    """
+    pa = importar_pyarrow()
+    return pa.ipc.open_file(pa.memory_map(caminho, "r"))
+
+
+def colunas_entrada(caminho):
+    """
+    Nomes das colunas do arquivo de entrada, lidos só do cabeçalho/esquema, sem carregar os dados.
+    """
+    extensao = extensao_entrada(caminho)
+    if extensao == ".csv":
+        return list(pd.read_csv(caminho, nrows=0).columns)
+    if extensao == ".xlsx":
+        from openpyxl import load_workbook
+
+        wb = load_workbook(caminho, read_only=True)
+        try:
+            return [c for c in next(wb.active.iter_rows(values_only=True), ()) if c is not None]
+        finally:
+            wb.close()
+    if extensao == ".parquet":
+        return importar_pyarrow().parquet.read_schema(caminho).names
+    return abrir_arrow(caminho).schema.names
+
+
+def tipar_coordenadas(df):
+    """
+    Converte latitude e longitude em float; as demais colunas seguem como foram lidas.
+    Coordenadas em texto com vírgula decimal ("-23,55") são aceitas; quantas linhas
+    precisaram da troca fica em df.attrs["coordenadas_virgula"].
+    """
+    virgula = np.zeros(len(df), dtype=bool)
+    for coluna in COLUNAS_COORDENADAS:
+        valores = df[coluna]
+        if not pd.api.types.is_numeric_dtype(valores):
+            textos = valores.astype(str)
+            com_virgula = textos.str.contains(",", regex=False).to_numpy()
+            if com_virgula.any():
+                virgula |= com_virgula
+                valores = valores.where(~com_virgula, textos.str.replace(",", ".", regex=False))
+        df[coluna] = pd.to_numeric(valores, errors="coerce").astype("float64")
+    df.attrs["coordenadas_virgula"] = int((virgula & df[COLUNAS_COORDENADAS].notna().all(axis=1).to_numpy()).sum())
+    return df
+
+
+# Retângulo que contém o Brasil, com as ilhas oceânicas: lat mín., lat máx., lon mín., lon máx.
+LIMITES_BRASIL = (-34.0, 5.5, -74.1, -28.6)
+COLUNA_VALIDACAO = "validacao_coordenada"
+# Situações da validação e como aparecem no log; só "valida" e "corrigida" seguem para a geocodificação
+SITUACOES_COORDENADA = {
+    "valida": "válidas",
+    "corrigida": "com lat/lon invertidas corrigidas",
+    "ausente": "sem coordenadas",
+    "fora_do_intervalo": "fora de [-90, 90] x [-180, 180]",
+    "zero": "em (0, 0)",
+    "invertida": "com lat/lon invertidas",
+    "fora_do_brasil": "fora do Brasil",
+}
+
+
+def validar_coordenadas(df, corrigir_invertidas=False, limites=LIMITES_BRASIL):
+    """
+    Classifica em bloco as coordenadas de cada linha: ausentes, fora de [-90, 90] x [-180, 180],
+    (0, 0), latitude e longitude trocadas (o ponto invertido cai no Brasil) e fora do Brasil.
+    Com corrigir_invertidas, as trocadas são desinvertidas no próprio DataFrame.
+    Retorna uma Series categórica com a situação de cada linha.
+    """
+    lat_min, lat_max, lon_min, lon_max = limites
+    lat = df["latitude"].to_numpy(dtype=float, copy=True)
+    lon = df["longitude"].to_numpy(dtype=float, copy=True)
+    with np.errstate(invalid="ignore"):
+        ausente = np.isnan(lat) | np.isnan(lon)
+        fora_intervalo = ~ausente & ((np.abs(lat) > 90) | (np.abs(lon) > 180))
+        zero = (lat == 0) & (lon == 0)
+        no_brasil = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+        invertida = (~fora_intervalo & ~no_brasil & (lon >= lat_min) & (lon <= lat_max)
+                     & (lat >= lon_min) & (lat <= lon_max))
+    situacao = np.select(
+        [ausente, fora_intervalo, zero, no_brasil, invertida],
+        ["ausente", "fora_do_intervalo", "zero", "valida", "corrigida" if corrigir_invertidas else "invertida"],
+        default="fora_do_brasil",
+    )
+    if corrigir_invertidas and invertida.any():
+        df.loc[invertida, "latitude"] = lon[invertida]
+        df.loc[invertida, "longitude"] = lat[invertida]
+    return pd.Series(pd.Categorical(situacao, categories=list(SITUACOES_COORDENADA)), index=df.index)
+
+
+def _tipos_sem_conversao(caminho, tipo):
+    # Só as coordenadas são interpretadas; o resto passa como foi lido, sem inferência de tipos
+    return {coluna: tipo for coluna in colunas_entrada(caminho) if coluna not in COLUNAS_COORDENADAS}
+
+
+def ler_entrada(caminho):
+    extensao = extensao_entrada(caminho)
+    if extensao == ".csv":
+        df = pd.read_csv(caminho, dtype=_tipos_sem_conversao(caminho, str))
+    elif extensao == ".xlsx":
+        df = pd.read_excel(caminho, dtype=_tipos_sem_conversao(caminho, object))
+    elif extensao == ".parquet":
+        df = pd.read_parquet(caminho)
+    else:
+        df = abrir_arrow(caminho).read_pandas()
+    return tipar_coordenadas(df)
+
+
+def ler_entrada_em_partes(caminho, tamanho):
+    """
+    Lê o arquivo de entrada em partes de `tamanho` linhas, sem carregá-lo inteiro na memória.
+    """
+    extensao = extensao_entrada(caminho)
+    if extensao == ".csv":
+        for parte in pd.read_csv(caminho, dtype=_tipos_sem_conversao(caminho, str), chunksize=tamanho):
+            yield tipar_coordenadas(parte)
+    elif extensao == ".xlsx":
+        from openpyxl import load_workbook
+
+        wb = load_workbook(caminho, read_only=True)
+        try:
+            linhas = wb.active.iter_rows(values_only=True)
+            cabecalho = next(linhas, ())
+            bloco = []
+            partes = 0
+            for linha in linhas:
+                bloco.append(linha)
+                if len(bloco) == tamanho:
+                    yield tipar_coordenadas(pd.DataFrame(bloco, columns=cabecalho))
+                    partes += 1
+                    bloco = []
+            if bloco or not partes:
+                yield tipar_coordenadas(pd.DataFrame(bloco, columns=cabecalho))
+        finally:
+            wb.close()
+    elif extensao == ".parquet":
+        arquivo = importar_pyarrow().parquet.ParquetFile(caminho)
+        partes = 0
+        for lote in arquivo.iter_batches(batch_size=tamanho):
+            yield tipar_coordenadas(lote.to_pandas())
+            partes += 1
+        if not partes:
+            yield tipar_coordenadas(arquivo.schema_arrow.empty_table().to_pandas())
+    else:
+        tabela = abrir_arrow(caminho).read_all()
+        for inicio in range(0, max(tabela.num_rows, 1), tamanho):
+            yield tipar_coordenadas(tabela.slice(inicio, tamanho).to_pandas())
+
+
+def contar_linhas_entrada(caminho):
+    """
+    Estima o número de linhas de dados do arquivo (para progresso no modo streaming).
+    """
+    extensao = extensao_entrada(caminho)
+    if extensao == ".xlsx":
+        from openpyxl import load_workbook
+
+        wb = load_workbook(caminho, read_only=True)
+        try:
+            return max((wb.active.max_row or 1) - 1, 0)
+        finally:
+            wb.close()
+    if extensao == ".parquet":
+        return importar_pyarrow().parquet.ParquetFile(caminho).metadata.num_rows
+    if extensao in (".feather", ".arrow"):
+        leitor = abrir_arrow(caminho)
+        return sum(leitor.get_batch(i).num_rows for i in range(leitor.num_record_batches))
+    quebras = 0
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1 << 20), b""):
+            quebras += bloco.count(b"\n")
+    return max(quebras - 1, 0)
+
+
+def caminho_saida(output_path, formato, em_partes=False):
+    """
+    Ajusta a extensão do arquivo de saída de acordo com o formato escolhido.
+    """
+    if not output_path:
+        output_path = DEFAULT_CONFIGS["output"]
+    if formato == "xlsx" and not output_path.lower().endswith(".xlsx"):
+        output_path += ".xlsx"
+    elif formato == "csv" and not output_path.lower().endswith(".csv"):
+        output_path += ".csv"
+    elif formato == "json" and em_partes and not output_path.lower().endswith(".jsonl"):
+        output_path += ".jsonl"  # JSON Lines permite acrescentar partes ao arquivo
+    elif formato == "json" and not em_partes and not output_path.lower().endswith(".json"):
+        output_path += ".json"
+    elif formato == "sql" and not (output_path.lower().endswith(".db") or output_path.lower().endswith(".sqlite") or output_path.lower().endswith(".sql")):
+        output_path += ".db"  # extensão padrão para sqlite
+    elif formato == "parquet" and not output_path.lower().endswith(".parquet"):
+        output_path += ".parquet"
+    elif formato == "feather" and not (output_path.lower().endswith(".feather") or output_path.lower().endswith(".arrow")):
+        output_path += ".feather"
+    return output_path
+
+
+MAX_LINHAS_XLSX = 1_048_576  # limite de linhas de uma planilha do Excel
+LOTE_SQL = 10_000  # linhas por executemany no SQLite
+FORMATOS_SAIDA = ("xlsx", "csv", "json", "sql", "parquet", "feather")
+EXTENSOES_SAIDA = (".xlsx", ".csv", ".json", ".jsonl", ".db", ".sqlite", ".sql", ".parquet", ".feather", ".arrow")
+
+
+def valores_python(df, datas_como_texto=False):
+    """
+    Colunas do DataFrame como listas de valores Python (None no lugar de NaN/NaT),
+    prontas para o executemany do SQLite e para o openpyxl.
+    """
+    colunas = []
+    for nome in df.columns:
+        serie = df[nome]
+        if datas_como_texto and pd.api.types.is_datetime64_any_dtype(serie):
+            serie = serie.dt.strftime("%Y-%m-%d %H:%M:%S")
+        serie = serie.astype(object)
+        colunas.append(serie.where(serie.notna(), None).tolist())
+    return colunas
+
+
+class EscritorSaida:
+    """
+    Grava o resultado no formato escolhido, acrescentando cada parte recebida ao arquivo.
+    No modo em partes o JSON é gravado como JSON Lines. Parquet e Feather são gravados
+    com o pyarrow (uma row group / record batch por parte), o SQLite em lotes numa transação
+    por parte e o Excel em modo write-only, abrindo uma nova planilha a cada 1.048.576 linhas.
+    No SQLite os atributos do município ficam numa tabela à parte, referenciada pelo
+    codigo_ibge, e uma view remonta o layout plano.
+    """
+
+    TABELA_SQL = "dados_geocodificacao"
+    TABELA_MUNICIPIOS = "municipios"
+    VIEW_SQL = "vw_dados_geocodificacao"
+    # Atributos do município que saem da tabela de dados e vão para a tabela de municípios
+    COLUNAS_MUNICIPIO = [c for c in COLUNAS_IBGE if c != "codigo_ibge"]
+    # Formatos em que a saída parcial pode ser truncada e continuada ao retomar
+    RETOMAVEIS = ("csv", "json", "sql")
+
+    def __init__(self, caminho, formato, em_partes=False):
+        formato = (formato or "xlsx").lower()
+        if formato not in FORMATOS_SAIDA:
+            raise ValueError(f"Formato de saída desconhecido: {formato}")
+        if formato in ("parquet", "feather"):
+            importar_pyarrow()
+        self.caminho = caminho
+        self.formato = formato
+        self.em_partes = em_partes
+        self.linhas = 0
+        self.partes = 0
+        self.conn = None
+        self.arrow = None  # ParquetWriter / RecordBatchFileWriter
+        self.schema = None
+        self.livro = None
+        self.planilha = None
+        self.linhas_planilha = 0
+
+    def escrever(self, df):
+        primeira = self.partes == 0
+        if self.formato == "csv":
+            df.to_csv(self.caminho, mode="w" if primeira else "a", header=primeira, index=False)
+        elif self.formato == "json" and self.em_partes:
+            # 15 casas (o máximo) para as coordenadas voltarem iguais ao serem lidas de novo
+            df.to_json(self.caminho, orient="records", lines=True, force_ascii=False, double_precision=15,
+                       mode="w" if primeira else "a")
+        elif self.formato == "json":
+            df.to_json(self.caminho, orient="records", force_ascii=False, double_precision=15, indent=2)
+        elif self.formato == "sql":
+            self._escrever_sql(df, primeira)
+        elif self.formato in ("parquet", "feather"):
+            self._escrever_arrow(df)
+        else:
+            # padrão xlsx
+            self._escrever_xlsx(df)
+        self.linhas += len(df)
+        self.partes += 1
+
+    def _conectar_sql(self):
+        self.conn = sqlite3.connect(self.caminho)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-65536")  # 64 MB
+
+    def _inserir_sql(self, tabela, df, verbo="INSERT"):
+        colunas = ", ".join(f'"{c}"' for c in df.columns)
+        marcadores = ", ".join("?" * len(df.columns))
+        insert = f'{verbo} INTO "{tabela}" ({colunas}) VALUES ({marcadores})'
+        linhas = list(zip(*valores_python(df, datas_como_texto=True))) if len(df.columns) else []
+        for inicio in range(0, len(linhas), LOTE_SQL):
+            self.conn.executemany(insert, linhas[inicio:inicio + LOTE_SQL])
+
+    def _criar_tabelas_sql(self, df, normalizado):
+        """
+        Recria as tabelas com o mesmo esquema que o to_sql criaria. Com os dados do IBGE,
+        os atributos do município vão para a tabela de municípios (uma linha por município)
+        e a tabela de dados guarda só o codigo_ibge como chave estrangeira.
+        """
+        self.conn.execute(f'DROP VIEW IF EXISTS "{self.VIEW_SQL}"')
+        self.conn.execute(f'DROP TABLE IF EXISTS "{self.TABELA_SQL}"')
+        self.conn.execute(f'DROP TABLE IF EXISTS "{self.TABELA_MUNICIPIOS}"')
+        if not normalizado:
+            self.conn.execute(pd.io.sql.get_schema(df, self.TABELA_SQL))
+            return
+        municipios = df[["codigo_ibge"] + self.COLUNAS_MUNICIPIO]
+        self.conn.execute(pd.io.sql.get_schema(municipios, self.TABELA_MUNICIPIOS, keys="codigo_ibge"))
+        esquema = pd.io.sql.get_schema(df.drop(columns=self.COLUNAS_MUNICIPIO), self.TABELA_SQL)
+        esquema = esquema.replace('"codigo_ibge" INTEGER',
+                                  f'"codigo_ibge" INTEGER REFERENCES "{self.TABELA_MUNICIPIOS}" (codigo_ibge)', 1)
+        self.conn.execute(esquema)
+        # View com o layout plano, na ordem original das colunas
+        campos = ", ".join(f'm."{c}"' if c in self.COLUNAS_MUNICIPIO else f'd."{c}"' for c in df.columns)
+        self.conn.execute(f'CREATE VIEW "{self.VIEW_SQL}" AS SELECT {campos} FROM "{self.TABELA_SQL}" d '
+                          f'LEFT JOIN "{self.TABELA_MUNICIPIOS}" m ON m.codigo_ibge = d.codigo_ibge')
+
+    def _escrever_sql(self, df, primeira):
+        if self.conn is None:
+            self._conectar_sql()
+        normalizado = all(c in df.columns for c in COLUNAS_IBGE)
+        if primeira:
+            with self.conn:
+                self._criar_tabelas_sql(df, normalizado)
+        with self.conn:  # uma transação por parte
+            if normalizado:
+                municipios = df[["codigo_ibge"] + self.COLUNAS_MUNICIPIO]
+                municipios = municipios[municipios["codigo_ibge"].notna()].drop_duplicates("codigo_ibge")
+                self._inserir_sql(self.TABELA_MUNICIPIOS, municipios, "INSERT OR IGNORE")
+                df = df.drop(columns=self.COLUNAS_MUNICIPIO)
+            self._inserir_sql(self.TABELA_SQL, df)
+
+    def _schema_arrow(self, df, schema):
+        """
+        Fixa o tipo das colunas categóricas para todas as partes: dicionário de strings no
+        Parquet (cada row group tem o seu) e string simples no Feather, cujo formato de
+        arquivo não aceita trocar o dicionário entre record batches.
+        """
+        pa = importar_pyarrow()
+        tipo = pa.dictionary(pa.int32(), pa.string()) if self.formato == "parquet" else pa.string()
+        for nome in df.columns:
+            if isinstance(df[nome].dtype, pd.CategoricalDtype):
+                i = schema.get_field_index(str(nome))
+                schema = schema.set(i, schema.field(i).with_type(tipo))
+        return schema
+
+    def _escrever_arrow(self, df):
+        pa = importar_pyarrow()
+        if self.arrow is None:
+            self.schema = self._schema_arrow(df, pa.Schema.from_pandas(df, preserve_index=False))
+            if self.formato == "parquet":
+                self.arrow = pa.parquet.ParquetWriter(self.caminho, self.schema)
+            else:
+                self.arrow = pa.ipc.new_file(self.caminho, self.schema)
+        self.arrow.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def _escrever_xlsx(self, df):
+        if self.livro is None:
+            from openpyxl import Workbook
+            self.livro = Workbook(write_only=True)
+        cabecalho = [str(c) for c in df.columns]
+        for linha in zip(*valores_python(df)):
+            if self.planilha is None or self.linhas_planilha >= MAX_LINHAS_XLSX:
+                numero = len(self.livro.worksheets) + 1
+                self.planilha = self.livro.create_sheet("Sheet1" if numero == 1 else f"Sheet{numero}")
+                self.planilha.append(cabecalho)
+                self.linhas_planilha = 1
+            self.planilha.append(linha)
+            self.linhas_planilha += 1
+
+    def posicao(self):
+        """
+        Posição atual da saída: tamanho em bytes (CSV/JSON Lines) ou linhas gravadas (demais).
+        """
+        if self.formato not in ("csv", "json"):
+            return self.linhas
+        return os.path.getsize(self.caminho) if os.path.exists(self.caminho) else 0
+
+    def retomar(self, partes, linhas, posicao):
+        """
+        Continua uma saída gravada em partes, descartando o que passou da última posição registrada.
+        Retorna False se o formato não permite continuar (Excel, Parquet, Feather) ou se o arquivo
+        não tem mais o que o diário registrou (apagado ou truncado); a saída precisa então ser
+        gravada desde o início.
+        """
+        if self.formato not in self.RETOMAVEIS or not os.path.exists(self.caminho):
+            return False
+        if self.formato == "sql":
+            self._conectar_sql()
+            try:
+                gravadas, = self.conn.execute(f'SELECT COUNT(*) FROM "{self.TABELA_SQL}" WHERE rowid <= ?',
+                                              (posicao,)).fetchone()
+            except sqlite3.Error:
+                gravadas = -1  # tabela inexistente
+            if gravadas != posicao:
+                return False
+            with self.conn:
+                self.conn.execute(f'DELETE FROM "{self.TABELA_SQL}" WHERE rowid > ?', (posicao,))
+        else:
+            if os.path.getsize(self.caminho) < posicao:
+                return False
+            with open(self.caminho, "r+b") as f:
+                f.truncate(posicao)
+        self.partes = partes
+        self.linhas = linhas
+        return True
+
+    def fechar(self):
+        if self.conn is not None:
+            colunas = [linha[1] for linha in self.conn.execute(f'PRAGMA table_info("{self.TABELA_SQL}")')]
+            if "codigo_ibge" in colunas:
+                # Índice criado depois da carga, que fica mais rápida sem ele
+                with self.conn:
+                    self.conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{self.TABELA_SQL}_codigo_ibge" '
+                                      f'ON "{self.TABELA_SQL}" (codigo_ibge)')
+            self.conn.close()
+            self.conn = None
+        if self.arrow is not None:
+            self.arrow.close()
+            self.arrow = None
+        if self.livro is not None:
+            if not self.livro.worksheets:
+                self.livro.create_sheet("Sheet1")
+            self.livro.save(self.caminho)
+            self.livro = None
+
+
+class DiarioProcessamento:
+    """
+    Diário (JSON Lines) gravado ao lado do arquivo de saída com as coordenadas já resolvidas
+    e as partes já gravadas, permitindo retomar uma execução interrompida do ponto em que parou.
+    A primeira linha guarda a assinatura da execução (arquivo de entrada e opções que afetam
+    o resultado); um diário com assinatura diferente é descartado.
+    """
+
+    VERSAO = 2  # formato dos registros: (cidade, estado, uf) por coordenada
+
+    def __init__(self, caminho, assinatura, intervalo=15.0):
+        self.caminho = caminho
+        self.assinatura = assinatura
+        self.intervalo = intervalo
+        self.pendentes = []
+        self.ultima_gravacao = time.monotonic()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def assinatura_entrada(caminho, **opcoes):
+        info = os.stat(caminho)
+        return dict(entrada=os.path.abspath(caminho), tamanho=info.st_size, modificado=info.st_mtime, **opcoes)
+
+    def retomar(self):
+        """
+        Lê o diário existente. Retorna (resultados, ultima_parte), em que ultima_parte é None ou
+        um dicionário com a parte, as linhas e a posição da saída registradas por último.
+        """
+        resultados = {}
+        ultima_parte = None
+        if os.path.exists(self.caminho):
+            try:
+                with open(self.caminho, "r", encoding="utf-8") as f:
+                    cabecalho = json.loads(f.readline() or "{}")
+                    if cabecalho.get("assinatura") == self.assinatura:
+                        for linha in f:
+                            try:
+                                registro = json.loads(linha)
+                            except ValueError:
+                                break  # última linha incompleta (interrupção durante a gravação)
+                            if "c" in registro:
+                                resultados[tuple(registro["c"])] = tuple(registro["r"])
+                            elif "parte" in registro:
+                                ultima_parte = registro
+            except Exception as e:
+                print(f"[ERRO] Lendo diário {self.caminho}: {e}")
+                resultados, ultima_parte = {}, None
+
+        # Reescreve o diário só com registros válidos, sob a assinatura atual
+        with open(self.caminho, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"assinatura": self.assinatura}) + "\n")
+            for chave, resultado in resultados.items():
+                f.write(json.dumps({"c": chave, "r": resultado}, ensure_ascii=False) + "\n")
+            if ultima_parte:
+                f.write(json.dumps(ultima_parte) + "\n")
+        return resultados, ultima_parte
+
+    def registrar(self, chave, resultado):
+        with self.lock:
+            self.pendentes.append({"c": chave, "r": resultado})
+            if time.monotonic() - self.ultima_gravacao >= self.intervalo:
+                self._gravar()
+
+    def registrar_parte(self, parte, linhas, posicao):
+        with self.lock:
+            self.pendentes.append({"parte": parte, "linhas": linhas, "posicao": posicao})
+            self._gravar()
+
+    def gravar(self):
+        with self.lock:
+            self._gravar()
+
+    def _gravar(self):
+        if self.pendentes:
+            with open(self.caminho, "a", encoding="utf-8") as f:
+                for registro in self.pendentes:
+                    f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.pendentes = []
+        self.ultima_gravacao = time.monotonic()
+
+    def concluir(self):
+        """
+        Remove o diário ao final de uma execução completa.
+        """
+        with self.lock:
+            self.pendentes = []
+            if os.path.exists(self.caminho):
+                os.remove(self.caminho)
+
+
+def ler_saida_anterior(caminho, colunas):
+    """
+    Lê de uma saída gravada anteriormente (em qualquer formato de saída) só as colunas
+    indicadas que existirem no arquivo.
+    """
+    extensao = os.path.splitext(caminho)[1].lower()
+    if extensao not in EXTENSOES_SAIDA:
+        raise ValueError(f"Formato da saída anterior não suportado: {caminho}")
+    if extensao == ".csv":
+        textos = {c: str for c in colunas if c not in COLUNAS_COORDENADAS}
+        df = pd.read_csv(caminho, usecols=lambda c: c in colunas, dtype=textos)
+    elif extensao in (".json", ".jsonl"):
+        df = pd.read_json(caminho, orient="records", lines=extensao == ".jsonl", dtype=False,
+                          precise_float=True)
+        df = df[[c for c in colunas if c in df.columns]]
+    elif extensao in (".db", ".sqlite", ".sql"):
+        conn = sqlite3.connect(caminho)
+        try:
+            # A view remonta o layout plano quando os municípios estão em tabela à parte
+            origem = EscritorSaida.VIEW_SQL
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (origem,)).fetchone():
+                origem = EscritorSaida.TABELA_SQL
+            existentes = [linha[1] for linha in conn.execute(f'PRAGMA table_info("{origem}")')]
+            campos = ", ".join(f'"{c}"' for c in colunas if c in existentes)
+            df = pd.read_sql_query(f'SELECT {campos} FROM "{origem}"', conn)
+        finally:
+            conn.close()
+    elif extensao == ".parquet":
+        nomes = importar_pyarrow().parquet.read_schema(caminho).names
+        df = pd.read_parquet(caminho, columns=[c for c in colunas if c in nomes])
+    elif extensao in (".feather", ".arrow"):
+        tabela = abrir_arrow(caminho).read_all()
+        df = tabela.select([c for c in colunas if c in tabela.column_names]).to_pandas()
+    else:
+        planilhas = pd.read_excel(caminho, sheet_name=None, usecols=lambda c: c in colunas, dtype=object)
+        df = pd.concat(planilhas.values(), ignore_index=True)
+    return df
+
+
+def localizar_saida_anterior(pasta, base):
+    """
+    Procura na pasta a saída anterior de nome `base` em qualquer formato ("" se não houver).
+    """
+    for extensao in EXTENSOES_SAIDA:
+        caminho = os.path.join(pasta, base + extensao)
+        if os.path.exists(caminho):
+            return caminho
+    return ""
+
+
+class SaidaAnterior:
+    """
+    Resultados de uma saída gravada numa execução anterior, para o modo incremental: as
+    linhas que não mudaram recebem o resultado já calculado e só as coordenadas novas ou
+    alteradas seguem para a geocodificação. Sem coluna-chave as linhas casam pelas
+    coordenadas; com ela, a linha precisa ter a mesma chave e as mesmas coordenadas.
+    Os dados do IBGE são recalculados a partir de (cidade, estado, uf), como numa execução completa.
+    """
+
+    def __init__(self, df, chave=None, precisao=None):
+        self.chave = chave or None
+        chaves, _ = chaves_coordenadas(df, precisao)
+        textos = {col: df[col].astype(object).where(df[col].notna(), "").astype(str)
+                  if col in df else pd.Series("", index=df.index) for col in ("cidade", "estado", "uf_sigla")}
+        # Linhas sem cidade e sem estado não tinham resultado e voltam para a geocodificação
+        validas = chaves.notna().all(axis=1) & ((textos["cidade"] != "") | (textos["estado"] != ""))
+        self.por_coordenada = {}
+        for lat, lon, cidade, estado, uf in zip(chaves["_lat"][validas], chaves["_lon"][validas],
+                                                textos["cidade"][validas], textos["estado"][validas],
+                                                textos["uf_sigla"][validas]):
+            self.por_coordenada.setdefault((lat, lon), (cidade, estado, uf or sigla_uf(estado)))
+        self.pares = None
+        if self.chave:
+            self.pares = pd.DataFrame({"_chave": df[self.chave].astype(str), "_lat": chaves["_lat"],
+                                       "_lon": chaves["_lon"]})[validas & df[self.chave].notna()]
+            self.pares = self.pares.drop_duplicates()
+
+    def __len__(self):
+        return len(self.por_coordenada)
+
+    @classmethod
+    def carregar(cls, caminho, chave=None, precisao=None):
+        colunas = COLUNAS_COORDENADAS + ["cidade", "estado", "uf_sigla"] + ([chave] if chave else [])
+        df = ler_saida_anterior(caminho, colunas)
+        faltando = [c for c in colunas if c != "uf_sigla" and c not in df.columns]
+        if faltando:
+            raise ValueError(f"A saída anterior não tem as colunas: {', '.join(faltando)}")
+        return cls(tipar_coordenadas(df), chave, precisao)
+
+    def reaproveitaveis(self, parte, chaves, resultados):
+        """
+        Resultados da saída anterior para as coordenadas da parte que ainda não têm resultado.
+        Retorna uma lista de ((lat, lon), resultado).
+        """
+        if self.chave:
+            validas = chaves.notna().all(axis=1) & parte[self.chave].notna()
+            atuais = pd.DataFrame({"_chave": parte[self.chave].astype(str), "_lat": chaves["_lat"],
+                                   "_lon": chaves["_lon"]})[validas].drop_duplicates()
+            candidatos = atuais.merge(self.pares, on=["_chave", "_lat", "_lon"], how="inner")
+        else:
+            candidatos = chaves.dropna()
+        candidatos = candidatos[["_lat", "_lon"]].drop_duplicates()
+        reaproveitados = []
+        for coordenada in zip(candidatos["_lat"], candidatos["_lon"]):
+            if coordenada not in resultados:
+                resultado = self.por_coordenada.get(coordenada)
+                if resultado is not None:
+                    reaproveitados.append((coordenada, resultado))
+        return reaproveitados
+
+
+class CacheGeocodificacao:
+    """
+    Cache persistente (SQLite) dos resultados da geocodificação reversa, chaveado pelas
+    coordenadas arredondadas. Remove as entradas menos usadas quando passa do limite
+    de entradas e, opcionalmente, descarta entradas mais velhas que a validade.
+    """
+
+    ARQUIVO_CACHE = "cache_geocodificacao.db"
+
+    def __init__(self, pasta_temp=DEFAULT_CONFIGS["pasta_temp"], precisao=5,
+                 max_entradas=1000000, ttl_dias=0):
+        os.makedirs(pasta_temp or ".", exist_ok=True)
+        self.caminho = os.path.join(pasta_temp or ".", self.ARQUIVO_CACHE)
+        self.precisao = precisao
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_dias * 86400
+        self.acertos = 0
+        self.falhas = 0
+        self._gravacoes = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.caminho, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocodificacao ("
+            "lat REAL NOT NULL, lon REAL NOT NULL, endereco TEXT NOT NULL, "
+            "criado_em REAL NOT NULL, acessado_em REAL NOT NULL, PRIMARY KEY (lat, lon))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_acessado_em ON geocodificacao (acessado_em)")
+        self.conn.commit()
+
+    def chave(self, latitude, longitude):
+        return round(float(latitude), self.precisao), round(float(longitude), self.precisao)
+
+    def obter(self, latitude, longitude):
+        """
+        Retorna o endereço em cache para as coordenadas, ou None se não houver entrada válida.
+        """
+        lat, lon = self.chave(latitude, longitude)
+        agora = time.time()
+        with self.lock:
+            linha = self.conn.execute(
+                "SELECT endereco, criado_em FROM geocodificacao WHERE lat = ? AND lon = ?", (lat, lon)
+            ).fetchone()
+            if linha is None or (self.ttl_segundos > 0 and agora - linha[1] > self.ttl_segundos):
+                self.falhas += 1
+                return None
+            self.conn.execute(
+                "UPDATE geocodificacao SET acessado_em = ? WHERE lat = ? AND lon = ?", (agora, lat, lon)
+            )
+            self.conn.commit()
+            self.acertos += 1
+        return json.loads(linha[0])
+
+    def gravar(self, latitude, longitude, endereco):
+        lat, lon = self.chave(latitude, longitude)
+        agora = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO geocodificacao (lat, lon, endereco, criado_em, acessado_em) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (lat, lon, json.dumps(endereco, ensure_ascii=False), agora, agora),
+            )
+            self.conn.commit()
+            self._gravacoes += 1
+            if self._gravacoes % 1000 == 0:
+                self._remover_excedentes()
+
+    def _remover_excedentes(self):
+        if self.ttl_segundos > 0:
+            self.conn.execute("DELETE FROM geocodificacao WHERE criado_em < ?",
+                              (time.time() - self.ttl_segundos,))
+        total = self.conn.execute("SELECT COUNT(*) FROM geocodificacao").fetchone()[0]
+        excedente = total - self.max_entradas
+        if self.max_entradas > 0 and excedente > 0:
+            self.conn.execute(
+                "DELETE FROM geocodificacao WHERE rowid IN "
+                "(SELECT rowid FROM geocodificacao ORDER BY acessado_em LIMIT ?)", (excedente,)
+            )
+        self.conn.commit()
+
+    def fechar(self):
+        with self.lock:
+            try:
+                self._remover_excedentes()
+            finally:
+                self.conn.close()
+
+
+class MalhaMunicipal:
+    """
+    Motor offline de geocodificação reversa sobre as malhas municipais do IBGE (GeoJSON).
+    Os polígonos são indexados numa grade regular pelas suas caixas envolventes e os
+    pontos de cada célula são testados em bloco (ray casting vetorizado com numpy).
+    """
+
+    ARQUIVO_MALHA = "BR_municipios.geojson"
+    TAMANHO_CELULA = 0.25  # graus
+    MAX_COMPARACOES = 4_000_000  # pontos x arestas avaliados por vez
+
+    def __init__(self, feicoes):
+        codigos, inicios, arestas, caixas = [], [0], [], []
+        for codigo, aneis in feicoes:
+            segmentos = []
+            for anel in aneis:
+                anel = np.asarray(anel, dtype=np.float64)[:, :2]
+                if len(anel) < 3:
+                    continue
+                segmentos.append(np.hstack([anel[:-1], anel[1:]]))
+            if not segmentos:
+                continue
+            segmentos = np.vstack(segmentos)
+            codigos.append(codigo)
+            arestas.append(segmentos)
+            inicios.append(inicios[-1] + len(segmentos))
+            xs = segmentos[:, [0, 2]]
+            ys = segmentos[:, [1, 3]]
+            caixas.append((xs.min(), ys.min(), xs.max(), ys.max()))
+
+        self.codigos = np.asarray(codigos, dtype=np.int64)
+        self.inicios = np.asarray(inicios, dtype=np.int64)
+        self.arestas = np.vstack(arestas) if arestas else np.empty((0, 4))
+        self.caixas = np.asarray(caixas, dtype=np.float64).reshape(-1, 4)
+
+        # Índice espacial: célula da grade -> partes de polígono cuja caixa a intersecta
+        self.grade = {}
+        celulas = np.floor(self.caixas / self.TAMANHO_CELULA).astype(np.int64)
+        for parte, (x0, y0, x1, y1) in enumerate(celulas):
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    self.grade.setdefault((cx, cy), []).append(parte)
+        self.grade = {celula: np.asarray(partes) for celula, partes in self.grade.items()}
+
+    def __len__(self):
+        return len(np.unique(self.codigos))
+
+    @staticmethod
+    def _feicoes_geojson(dados):
+        for feicao in dados.get("features", []):
+            propriedades = feicao.get("properties") or {}
+            codigo = propriedades.get("codarea") or propriedades.get("CD_MUN") or propriedades.get("id")
+            geometria = feicao.get("geometry") or {}
+            if not codigo or not geometria:
+                continue
+            if geometria.get("type") == "Polygon":
+                poligonos = [geometria["coordinates"]]
+            elif geometria.get("type") == "MultiPolygon":
+                poligonos = geometria["coordinates"]
+            else:
+                continue
+            for aneis in poligonos:
+                yield int(codigo), aneis
+
+    @classmethod
+    def baixar(cls, pasta_temp, url_malhas=URL_MALHAS, limitador=None):
+        params = {
+            "intrarregiao": "municipio",
+            "formato": "application/vnd.geo+json",
+            "qualidade": "intermediaria",
+        }
+        response = requisicao_get(url_malhas, limitador, params=params, timeout=120)
+        os.makedirs(pasta_temp or ".", exist_ok=True)
+        caminho = os.path.join(pasta_temp or ".", cls.ARQUIVO_MALHA)
+        with open(caminho, "wb") as f:
+            f.write(response.content)
+        return caminho
+
+    @classmethod
+    def carregar(cls, pasta_temp=DEFAULT_CONFIGS["pasta_temp"], url_malhas=URL_MALHAS, limitador=None):
+        """
+        Carrega todas as malhas GeoJSON da pasta temporária, baixando a malha do Brasil
+        quando a pasta ainda não tiver nenhuma.
+        """
+        pasta = pasta_temp or "."
+        arquivos = []
+        if os.path.isdir(pasta):
+            arquivos = [os.path.join(pasta, nome) for nome in sorted(os.listdir(pasta))
+                        if nome.lower().endswith((".geojson", ".json"))
+                        and nome != IndiceMunicipios.ARQUIVO_CACHE]
+        if not arquivos:
+            arquivos = [cls.baixar(pasta, url_malhas, limitador)]
+
+        feicoes = []
+        for caminho in arquivos:
+            with open(caminho, "r", encoding="utf-8") as f:
+                feicoes.extend(cls._feicoes_geojson(json.load(f)))
+        if not feicoes:
+            raise ValueError(f"Nenhuma malha municipal encontrada em {pasta}.")
+        return cls(feicoes)
+
+    def _dentro(self, parte, px, py):
+        """
+        Testa (par/ímpar) quais pontos estão dentro da parte de polígono indicada.
+        """
+        arestas = self.arestas[self.inicios[parte]:self.inicios[parte + 1]]
+        x1, y1, x2, y2 = (arestas[:, i] for i in range(4))
+        dentro = np.zeros(len(px), dtype=bool)
+        bloco = max(1, self.MAX_COMPARACOES // len(arestas))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i in range(0, len(px), bloco):
+                bx = px[i:i + bloco, None]
+                by = py[i:i + bloco, None]
+                cruza = (y1 > by) != (y2 > by)
+                x_corte = (x2 - x1) * (by - y1) / (y2 - y1) + x1
+                dentro[i:i + bloco] = np.count_nonzero(cruza & (bx < x_corte), axis=1) % 2 == 1
+        return dentro
+
+    def localizar(self, latitudes, longitudes):
+        """
+        Retorna um array com o código IBGE do município de cada ponto (0 quando fora das malhas).
+        """
+        lat = np.asarray(latitudes, dtype=np.float64)
+        lon = np.asarray(longitudes, dtype=np.float64)
+        resultado = np.zeros(len(lat), dtype=np.int64)
+        validos = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+        if len(validos) == 0:
+            return resultado
+
+        cx = np.floor(lon[validos] / self.TAMANHO_CELULA).astype(np.int64)
+        cy = np.floor(lat[validos] / self.TAMANHO_CELULA).astype(np.int64)
+        celulas, inverso = np.unique(np.stack([cx, cy], axis=1), axis=0, return_inverse=True)
+        inverso = inverso.ravel()
+        ordem = np.argsort(inverso, kind="stable")
+        limites = np.searchsorted(inverso[ordem], np.arange(len(celulas) + 1))
+
+        for n, (celx, cely) in enumerate(celulas):
+            partes = self.grade.get((int(celx), int(cely)))
+            if partes is None:
+                continue
+            pontos = validos[ordem[limites[n]:limites[n + 1]]]
+            for parte in partes:
+                pendentes = pontos[resultado[pontos] == 0]
+                if len(pendentes) == 0:
+                    break
+                x0, y0, x1, y1 = self.caixas[parte]
+                px, py = lon[pendentes], lat[pendentes]
+                na_caixa = (px >= x0) & (px <= x1) & (py >= y0) & (py <= y1)
+                if not na_caixa.any():
+                    continue
+                candidatos = pendentes[na_caixa]
+                dentro = self._dentro(parte, lon[candidatos], lat[candidatos])
+                resultado[candidatos[dentro]] = self.codigos[parte]
+        return resultado
+
+
+def aquecer(configs, ao_log=print):
+    """
+    Prepara em segundo plano o que a primeira execução vai usar: conclui as importações
+    tardias, carrega o índice de municípios do IBGE e abre a conexão com o Nominatim.
+    """
+    global _sessao_aquecida
+    inicio = time.perf_counter()
+    carregar_modulos_tardios()
+    partes = []
+
+    try:
+        limitador = LimitadorTaxa(config_numero(configs, "requisicoes_por_segundo"),
+                                  config_numero(configs, "rajada", int))
+        indice = obter_indice_municipios(configs.get("api_ibge_url", URL_IBGE),
+                                         configs.get("pasta_temp") or DEFAULT_CONFIGS["pasta_temp"],
+                                         config_numero(configs, "ibge_ttl_horas"), limitador)
+        partes.append(f"índice IBGE com {len(indice)} municípios")
     except Exception as e:
-        print(f"[ERRO] Buscando dados IBGE: {e}")
-        return ("", "", "", "", "", "", "")
+        ao_log(f"Aquecimento: falha ao carregar municípios do IBGE: {e}")
+
+    if configs.get("modo_geocodificacao", "nominatim") != "offline":
+        conexoes = max(config_numero(configs, "workers", int), 1)
+        sessao = criar_sessao(conexoes)
+        try:
+            sessao.head(configs.get("api_nominatim_url", URL_NOMINATIM), timeout=5,
+                        headers={"User-Agent": configs.get("user_agent", DEFAULT_CONFIGS["user_agent"])})
+            with _lock_sessao:
+                _sessao_aquecida = (conexoes, sessao)
+            partes.append("conexão com o Nominatim aberta")
+        except Exception as e:
+            sessao.close()
+            ao_log(f"Aquecimento: Nominatim indisponível ({e}).")
+
+    ao_log(f"Aquecimento concluído em {time.perf_counter() - inicio:.1f}s"
+           + (f": {', '.join(partes)}." if partes else "."))
+
+
+def formatar_tempo(segundos):
+    """
+    Formata segundos em H:M:S.
+    """
+    h = int(segundos // 3600)
+    m = int((segundos % 3600) // 60)
+    s = int(segundos % 60)
+    return f"{h:02d}:{m:02d}:{s:02d}"
+
+
+class TaxaMovel:
+    """
+    Taxa de processamento (linhas/s) como média móvel exponencial, para a estimativa de
+    tempo restante acompanhar mudanças de ritmo (cache, 429, pausas) em vez da média acumulada.
+    """
+
+    def __init__(self, constante_tempo=30.0, intervalo_minimo=1.0):
+        self.constante_tempo = constante_tempo
+        self.intervalo_minimo = intervalo_minimo
+        self.taxa = None
+        self._ultimo_tempo = None
+        self._ultimo_valor = 0
+
+    def atualizar(self, processados, agora=None):
+        agora = time.monotonic() if agora is None else agora
+        if self._ultimo_tempo is None:
+            self._ultimo_tempo, self._ultimo_valor = agora, processados
+            return self.taxa
+        dt = agora - self._ultimo_tempo
+        if dt < self.intervalo_minimo:
+            return self.taxa
+        instantanea = max(processados - self._ultimo_valor, 0) / dt
+        if self.taxa is None:
+            self.taxa = instantanea
+        else:
+            alfa = 1 - math.exp(-dt / self.constante_tempo)
+            self.taxa += alfa * (instantanea - self.taxa)
+        self._ultimo_tempo, self._ultimo_valor = agora, processados
+        return self.taxa
+
+
+class Metricas:
+    """
+    Contadores, medidores (valores pontuais, como o tempo até o primeiro resultado) e
+    histogramas de latência por etapa do processamento (leitura, cache, Nominatim,
+    enriquecimento IBGE, escrita, interface...), exportáveis em JSON ou no formato
+    texto do Prometheus.
+    """
+
+    LIMITES = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
-class App(tk.Tk):
+    def __init__(self):
+        self.contadores = {}
+        self.medidores = {}
+        self.etapas = {}  # etapa -> [contagens por limite + inf, quantidade, soma]
+        self.inicio = time.time()
+        self.lock = threading.Lock()
+
+    def contar(self, nome, valor=1):
+        with self.lock:
+            self.contadores[nome] = self.contadores.get(nome, 0) + valor
+
+    def definir(self, nome, valor):
+        with self.lock:
+            self.medidores[nome] = valor
+
+    def observar(self, etapa, segundos):
+        with self.lock:
+            hist = self.etapas.get(etapa)
+            if hist is None:
+                hist = self.etapas[etapa] = [[0] * (len(self.LIMITES) + 1), 0, 0.0]
+            indice = len(self.LIMITES)
+            for i, limite in enumerate(self.LIMITES):
+                if segundos <= limite:
+                    indice = i
+                    break
+            hist[0][indice] += 1
+            hist[1] += 1
+            hist[2] += segundos
+
+    @contextmanager
+    def medir(self, etapa):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(etapa, time.perf_counter() - inicio)
+
+    def iterar(self, iteravel, etapa):
+        """
+        Repassa os itens de `iteravel` medindo o tempo gasto para produzir cada um.
+        """
+        iterador = iter(iteravel)
+        while True:
+            with self.medir(etapa):
+                try:
+                    item = next(iterador)
+                except StopIteration:
+                    return
+            yield item
+
+    def resumo(self):
+        """
+        Texto curto com o tempo total por etapa, em ordem decrescente.
+        """
+        with self.lock:
+            etapas = sorted(self.etapas.items(), key=lambda item: -item[1][2])
+            return ", ".join(f"{etapa} {hist[2]:.1f}s ({hist[1]}x)" for etapa, hist in etapas)
+
+    def como_dict(self):
+        with self.lock:
+            etapas = {}
+            for etapa, (contagens, quantidade, soma) in self.etapas.items():
+                acumulado, buckets = 0, {}
+                for limite, contagem in zip(self.LIMITES + ("+Inf",), contagens):
+                    acumulado += contagem
+                    buckets[str(limite)] = acumulado
+                etapas[etapa] = {"quantidade": quantidade, "soma_segundos": round(soma, 6),
+                                 "media_segundos": round(soma / quantidade, 6) if quantidade else 0.0,
+                                 "buckets": buckets}
+            return {"inicio": self.inicio, "duracao_segundos": round(time.time() - self.inicio, 3),
+                    "contadores": dict(self.contadores), "medidores": dict(self.medidores),
+                    "etapas": etapas}
+
+    def como_prometheus(self):
+        dados = self.como_dict()
+        linhas = ["# TYPE geoapp_duracao_segundos gauge",
+                  f"geoapp_duracao_segundos {dados['duracao_segundos']}"]
+        for nome, valor in sorted(dados["contadores"].items()):
+            linhas.append(f"# TYPE geoapp_{nome} counter")
+            linhas.append(f"geoapp_{nome} {valor}")
+        for nome, valor in sorted(dados["medidores"].items()):
+            linhas.append(f"# TYPE geoapp_{nome} gauge")
+            linhas.append(f"geoapp_{nome} {valor}")
+        linhas.append("# TYPE geoapp_etapa_segundos histogram")
+        for etapa, hist in sorted(dados["etapas"].items()):
+            for limite, acumulado in hist["buckets"].items():
+                linhas.append(f'geoapp_etapa_segundos_bucket{{etapa="{etapa}",le="{limite}"}} {acumulado}')
+            linhas.append(f'geoapp_etapa_segundos_sum{{etapa="{etapa}"}} {hist["soma_segundos"]}')
+            linhas.append(f'geoapp_etapa_segundos_count{{etapa="{etapa}"}} {hist["quantidade"]}')
+        return "\n".join(linhas) + "\n"
+
+    def exportar(self, caminho):
+        """
+        Grava as métricas em `caminho`: JSON se a extensão for .json, senão texto do Prometheus.
+        A escrita é atômica, para que um coletor nunca leia o arquivo pela metade.
+        """
+        if caminho.lower().endswith(".json"):
+            conteudo = json.dumps(self.como_dict(), ensure_ascii=False, indent=2)
+        else:
+            conteudo = self.como_prometheus()
+        temporario = caminho + ".tmp"
+        with open(temporario, "w", encoding="utf-8") as f:
+            f.write(conteudo)
+        os.replace(temporario, caminho)
+
+
+class MotorGeocodificacao:
+    """
+    Pipeline de geocodificação independente da interface: lê a entrada, geocodifica as
+    coordenadas únicas e grava a saída de acordo com as configurações (as mesmas do .conf).
+    A interface Tk e a linha de comando recebem mensagens e progresso pelos callbacks.
+    """
+
+    def __init__(self, configs, ao_log=None, ao_progresso=None, ao_status=None, ao_erro=None,
+                 pause_flag=None, cancel_flag=None, compartilhado=None):
+        self.configs = configs
+        self.compartilhado = compartilhado  # RecursosCompartilhados quando roda numa fila
+        self.ao_log = ao_log or print
+        self.ao_progresso = ao_progresso
+        self.ao_status = ao_status
+        self.ao_erro = ao_erro
+        self.pause_flag = pause_flag or threading.Event()
+        if pause_flag is None:
+            self.pause_flag.set()  # rodando
+        self.cancel_flag = cancel_flag or threading.Event()
+
+        self.df = None
+        self.lock = threading.Lock()
+        self.processed_lines = 0
+        self.total_lines = 0
+        self.tempo_inicio = None
+        self.streaming = False
+        self.log_por_linha = False
+        self.falhas = 0
+        self.celulas = {}
+        self.casas_celula = None
+        self.primeiro_resultado = None
+        self.adiadas = []
+        self.em_retentativa = False
+        self.disjuntor = None
+        self.timeout = float(DEFAULT_CONFIGS["timeout_segundos"])
+        self.metricas = Metricas()
+        self.taxa_movel = TaxaMovel()
+        self.arquivo_metricas = ""
+        self._ultima_exportacao = 0.0
+
+    def log(self, msg):
+        with self.metricas.medir("interface"):
+            self.ao_log(msg)
+
+    def status(self, texto):
+        if self.ao_status:
+            self.ao_status(texto)
+
+    def erro(self, msg):
+        if self.ao_erro:
+            self.ao_erro(msg)
+
+    def progresso(self):
+        if self.ao_progresso:
+            with self.metricas.medir("interface"):
+                self.ao_progresso(self.processed_lines, self.total_lines, self.tempo_restante())
+        if self.arquivo_metricas and time.monotonic() - self._ultima_exportacao >= self.intervalo_metricas:
+            self.exportar_metricas()
+
+    def tempo_restante(self):
+        """
+        Estimativa em segundos do tempo restante (None enquanto não há linhas processadas).
+        Usa a taxa móvel recente; até haver amostras suficientes, a média desde o início.
+        """
+        if self.processed_lines == 0 or self.tempo_inicio is None:
+            return None
+        linhas_restantes = max(self.total_lines - self.processed_lines, 0)
+        taxa = self.taxa_movel.atualizar(self.processed_lines)
+        if taxa is None:
+            taxa = self.processed_lines / max(time.time() - self.tempo_inicio, 1e-9)
+        if taxa <= 0:
+            return None
+        return linhas_restantes / taxa
+
+    def exportar_metricas(self):
+        """
+        Grava as métricas no arquivo configurado (metricas_arquivo), se houver.
+        """
+        self._ultima_exportacao = time.monotonic()
+        if not self.arquivo_metricas:
+            return
+        # Leituras do estado atual, não totais acumulados por este motor (o limitador e o disjuntor
+        # podem ser compartilhados com outros trabalhos): saem como medidores
+        m = self.metricas
+        if getattr(self, "limitador", None) is not None:
+            m.definir("limitador_espera_segundos", round(self.limitador.espera_total, 3))
+            m.definir("http_rejeicoes", self.limitador.rejeicoes)
+        m.definir("linhas_processadas", self.processed_lines)
+        if self.disjuntor is not None:
+            m.definir("disjuntor_aberturas", self.disjuntor.aberturas)
+        try:
+            m.exportar(self.arquivo_metricas)
+        except OSError as e:
+            self.log(f"Falha ao exportar métricas: {e}")
+
+    def config_numero(self, chave, tipo=float):
+        return config_numero(self.configs, chave, tipo)
+
+    def get_precisao_coordenadas(self):
+        """
+        Casas decimais usadas para agrupar coordenadas próximas (None = coordenadas exatas).
+        """
+        try:
+            return int(self.configs.get("precisao_coordenadas", ""))
+        except (TypeError, ValueError):
+            return None
+
+    def get_casas_celula(self):
+        """
+        Casas decimais da célula em que um município resolvido é reaproveitado para os
+        pontos seguintes (None = desligado; 3 casas ~ 110 m).
+        """
+        try:
+            return int(self.configs.get("reuso_celula_casas", ""))
+        except (TypeError, ValueError):
+            return None
+
+    def celula(self, lat, lon):
+        fator = 10 ** self.casas_celula
+        return math.floor(lat * fator), math.floor(lon * fator)
+
+    def executar(self):
+        """
+        Executa o processamento completo. Retorna True se todas as linhas foram processadas.
+        """
+        self.tempo_inicio = time.time()
+        carregar_modulos_tardios()  # antes de abrir os workers
+        self.log_por_linha = self.configs.get("log_por_linha", "0") == "1"
+        self.falhas = 0
+        self.primeiro_resultado = None
+        self.adiadas = []
+        self.em_retentativa = False
+        self.disjuntor = None
+        self.timeout = float(DEFAULT_CONFIGS["timeout_segundos"])
+        self.metricas = Metricas()
+        self.taxa_movel = TaxaMovel()
+        self.arquivo_metricas = self.configs.get("metricas_arquivo", "")
+        self.intervalo_metricas = self.config_numero("metricas_segundos")
+        self._ultima_exportacao = time.monotonic()
+        caminho = self.configs.get("input_csv", "")
+        self.streaming = self.configs.get("modo_streaming", "0") == "1"
+        tamanho_parte = max(self.config_numero("tamanho_parte", int), 1)
+
+        try:
+            # As colunas são conferidas no esquema do arquivo, antes de carregar os dados
+            colunas = colunas_entrada(caminho)
+            if any(coluna not in colunas for coluna in COLUNAS_COORDENADAS):
+                self.erro("O arquivo deve conter colunas chamadas 'latitude' e 'longitude'.")
+                return False
+            with self.metricas.medir("leitura"):
+                if self.streaming:
+                    partes = ler_entrada_em_partes(caminho, tamanho_parte)
+                    self.df = next(partes)
+                else:
+                    self.df = ler_entrada(caminho)
+        except Exception as e:
+            self.log(f"Erro ao carregar arquivo: {e}")
+            self.erro(f"Erro ao carregar arquivo:\n{e}")
+            return False
+
+        # Resultados por coordenada única, compartilhados entre as partes do arquivo (e, na fila,
+        # entre os arquivos). Cada parte usa a própria cópia dos resultados de que precisa
+        # (resultados_parte), e no modo streaming cada motor só descarta as chaves que inseriu.
+        self.resultados = self.compartilhado.resultados if self.compartilhado else {}
+        self.resultados_parte = {}
+        self.chaves_proprias = []
+        self.precisao = self.get_precisao_coordenadas()
+        self.ordem_espacial = self.configs.get("ordem_espacial", "0") == "1"
+        self.casas_celula = self.get_casas_celula()
+        self.celulas = {}
+        self.processed_lines = 0
+        self.validacao = self.configs.get("validacao_coordenadas", "marcar").strip().lower()
+        if self.validacao not in ("marcar", "rejeitar"):
+            self.validacao = None  # desligada: só as linhas sem coordenadas ficam de fora
+        self.corrigir_invertidas = self.configs.get("corrigir_invertidas", "0") == "1"
+        self.situacoes = Counter()
+
+        self.anterior = None
+        arquivo_anterior = self.configs.get("saida_anterior", "")
+        if arquivo_anterior:
+            chave = self.configs.get("chave_incremental", "").strip()
+            try:
+                if chave and chave not in colunas:
+                    raise ValueError(f"A coluna-chave '{chave}' não existe no arquivo de entrada.")
+                with self.metricas.medir("saida_anterior"):
+                    self.anterior = SaidaAnterior.carregar(arquivo_anterior, chave, self.precisao)
+            except Exception as e:
+                self.log(f"Erro ao carregar a saída anterior: {e}")
+                self.erro(f"Erro ao carregar a saída anterior:\n{e}")
+                return False
+            self.log(f"Modo incremental: {len(self.anterior)} coordenadas com resultado em {arquivo_anterior}"
+                     + (f", casadas pela coluna '{chave}'." if chave else "."))
+        if self.streaming:
+            partes = chain([self.df], self.metricas.iterar(partes, "leitura"))
+            self.total_lines = contar_linhas_entrada(caminho)
+        else:
+            partes = [self.df]
+            self.total_lines = 0
+
+        if self.compartilhado:
+            self.limitador = self.compartilhado.limitador
+        else:
+            self.limitador = LimitadorTaxa(self.config_numero("requisicoes_por_segundo"),
+                                           self.config_numero("rajada", int), self.cancel_flag)
+        self.user_agent = self.configs.get("user_agent", DEFAULT_CONFIGS["user_agent"])
+        self.url_ibge = self.configs.get("api_ibge_url", URL_IBGE)
+        self.url_nominatim = self.configs.get("api_nominatim_url", URL_NOMINATIM)
+        self.pasta_temp = self.configs.get("pasta_temp") or DEFAULT_CONFIGS["pasta_temp"]
+        self.ibge_ttl = self.config_numero("ibge_ttl_horas")
+
+        self.indice = None
+        try:
+            with self.metricas.medir("indice_ibge"):
+                self.indice = obter_indice_municipios(self.url_ibge, self.pasta_temp, self.ibge_ttl,
+                                                      self.limitador)
+            self.log(f"Índice IBGE carregado com {len(self.indice)} municípios.")
+        except Exception as e:
+            self.log(f"Falha ao carregar municípios do IBGE: {e}")
+
+        self.malha = None
+        self.cache = None
+        self.sessao = None
+        self.executor = None
+        self.diario = None
+        escritor = None
+        concluido = False
+
+        try:
+            if self.configs.get("modo_geocodificacao") == "offline":
+                self.preparar_offline()
+            else:
+                self.preparar_online()
+
+            formato = self.configs.get("formato_saida", "xlsx").lower()
+            assinatura = DiarioProcessamento.assinatura_entrada(
+                caminho, modo=self.configs.get("modo_geocodificacao", "nominatim"), precisao=self.precisao,
+                streaming=self.streaming, tamanho_parte=tamanho_parte if self.streaming else None,
+                formato=formato, validacao=self.validacao, corrigir_invertidas=self.corrigir_invertidas,
+                reuso_celula_casas=self.casas_celula, nominatim=self.url_nominatim,
+                saida_anterior=self.configs.get("saida_anterior", ""), versao=DiarioProcessamento.VERSAO,
+            )
+            self.diario = DiarioProcessamento(self.caminho_saida() + ".diario", assinatura,
+                                              self.config_numero("checkpoint_segundos"))
+            resultados, ultima_parte = self.diario.retomar()
+            self.resultados.update(resultados)
+            if self.streaming:
+                self.chaves_proprias.extend(resultados)
+            if resultados or ultima_parte:
+                self.log(f"Retomando execução anterior: {len(resultados)} coordenadas já resolvidas"
+                         + (f", {ultima_parte['parte']} partes já gravadas." if ultima_parte else "."))
+
+            partes_gravadas = 0
+            if self.streaming:
+                escritor = EscritorSaida(self.caminho_saida(), formato, em_partes=True)
+                if ultima_parte:
+                    if escritor.retomar(ultima_parte["parte"], ultima_parte["linhas"], ultima_parte["posicao"]):
+                        partes_gravadas = ultima_parte["parte"]
+                    else:
+                        motivo = (f"o formato {formato} não permite continuar o arquivo"
+                                  if formato not in EscritorSaida.RETOMAVEIS
+                                  else "o arquivo parcial não corresponde ao checkpoint")
+                        self.log(f"A saída será regravada desde o início: {motivo} "
+                                 "(as coordenadas já resolvidas são reaproveitadas).")
+                self.log(f"Modo streaming: partes de {tamanho_parte} linhas gravadas em {escritor.caminho}.")
+
+            for numero, parte in enumerate(partes, start=1):
+                if self.cancel_flag.is_set():
+                    break
+                if numero <= partes_gravadas:
+                    with self.lock:
+                        self.processed_lines += len(parte)
+                    continue
+                linhas_lidas = len(parte)
+                self.df = parte = self.validar_parte(parte, numero)
+                self.processar_parte(parte, numero)
+
+                if self.streaming:
+                    if self.cancel_flag.is_set():
+                        break  # parte incompleta não é gravada; será refeita ao retomar
+                    with self.metricas.medir("escrita"):
+                        escritor.escrever(parte)
+                    with self.metricas.medir("checkpoint"):
+                        self.diario.registrar_parte(numero, escritor.linhas, escritor.posicao())
+                    with self.lock:
+                        self.processed_lines += linhas_lidas
+                    self.progresso()
+                    # Mantém a memória estável; o cache SQLite continua servindo as repetições.
+                    # Só saem as chaves deste motor: outros arquivos da fila podem estar usando as suas.
+                    if len(self.chaves_proprias) > LIMITE_RESULTADOS_MEMORIA:
+                        for chave in self.chaves_proprias:
+                            self.resultados.pop(chave, None)
+                        self.chaves_proprias = []
+                        self.celulas.clear()
+
+            if self.streaming and self.situacoes:
+                invalidas = sum(n for nome, n in self.situacoes.items() if nome not in ("valida", "corrigida"))
+                self.log(f"Validação das coordenadas no arquivo: {self.situacoes['valida']} válidas, "
+                         f"{self.situacoes['corrigida']} corrigidas, {invalidas} inválidas.")
+            if self.falhas:
+                self.log(f"{self.falhas} coordenadas sem resultado na geocodificação reversa.")
+            if self.disjuntor is not None and self.disjuntor.aberturas:
+                self.log(f"O Nominatim ficou suspenso pelo disjuntor {self.disjuntor.aberturas} vez(es).")
+            if self.limitador.rejeicoes:
+                self.log(f"A API recusou {self.limitador.rejeicoes} requisições (429/503); "
+                         f"taxa final {self.limitador.taxa:.2f} req/s.")
+            if not self.cancel_flag.is_set():
+                concluido = True
+                self.status("Status: Finalizado")
+
+        except Exception as e:
+            self.log(f"Erro durante processamento: {e}")
+            self.erro(f"Erro durante o processamento:\n{e}")
+
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+                self.sessao.close()
+            if self.cache and not self.compartilhado:
+                self.log(f"Cache de geocodificação: {self.cache.acertos} acertos, {self.cache.falhas} falhas.")
+                self.cache.fechar()
+            salvo = True
+            if escritor:
+                try:
+                    escritor.fechar()
+                    self.log(f"{escritor.linhas} linhas gravadas em: {escritor.caminho}")
+                except Exception as e:
+                    salvo = False
+                    self.log(f"Erro ao fechar o arquivo de saída: {e}")
+                    self.erro(f"Erro ao fechar o arquivo de saída:\n{e}")
+            if not self.finalizar_processamento():
+                salvo = False
+            if not salvo:
+                concluido = False  # sem a saída gravada a execução não terminou (status != 0 na CLI)
+                self.status("Status: Erro ao gravar a saída")
+            # O diário só sai depois que a saída foi gravada: se a gravação falhar, a próxima
+            # execução ainda reaproveita os resultados já obtidos
+            if self.diario:
+                if concluido:
+                    self.diario.concluir()
+                else:
+                    with self.metricas.medir("checkpoint"):
+                        self.diario.gravar()
+                    self.log(f"Checkpoint salvo em {self.diario.caminho}; execute novamente para retomar.")
+            self.log(f"Tempo por etapa: {self.metricas.resumo()}")
+            if self.arquivo_metricas:
+                self.exportar_metricas()
+                self.log(f"Métricas gravadas em: {self.arquivo_metricas}")
+        return concluido
+
+    def abrir_cache(self):
+        return CacheGeocodificacao(self.pasta_temp, self.config_numero("cache_precisao", int),
+                                   self.config_numero("cache_max_entradas", int),
+                                   self.config_numero("cache_ttl_dias"))
+
+    def preparar_online(self):
+        try:
+            if self.compartilhado:
+                self.cache = self.compartilhado.obter("cache", self.abrir_cache)
+            else:
+                self.cache = self.abrir_cache()
+        except Exception as e:
+            self.log(f"Cache de geocodificação indisponível: {e}")
+
+        self.workers = max(self.config_numero("workers", int), 1)
+        self.timeout = self.config_numero("timeout_segundos")
+        self.disjuntor = obter_disjuntor(self.url_nominatim, self.config_numero("disjuntor_falhas", int),
+                                         self.config_numero("disjuntor_segundos"))
+        self.sessao = obter_sessao(self.workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.log(f"Geocodificação via Nominatim com {self.workers} worker(s), "
+                 f"até {self.limitador.taxa_maxima:g} req/s (rajada {self.limitador.rajada}).")
+        self.status("Status: Processando...")
+
+    def preparar_offline(self):
+        if self.indice is None:
+            raise ValueError("Índice de municípios do IBGE indisponível.")
+        url_malhas = self.configs.get("api_malhas_url") or URL_MALHAS
+        self.log("Carregando malhas municipais do IBGE...")
+        carregar = partial(MalhaMunicipal.carregar, self.pasta_temp, url_malhas, self.limitador)
+        self.malha = self.compartilhado.obter("malha", carregar) if self.compartilhado else carregar()
+        self.log(f"Malhas carregadas: {len(self.malha)} municípios.")
+        self.status("Status: Processando (offline)...")
+
+    def validar_parte(self, parte, numero):
+        """
+        Valida as coordenadas da parte antes de qualquer requisição e informa as contagens.
+        No modo "marcar" a situação vai para a coluna validacao_coordenada da saída; no modo
+        "rejeitar" as linhas inválidas são retiradas. Retorna a parte a processar.
+        """
+        virgula = parte.attrs.get("coordenadas_virgula", 0)
+        if virgula:
+            self.metricas.contar("coordenadas_virgula_total", virgula)
+        if self.validacao is None:
+            return parte
+        with self.metricas.medir("validacao"):
+            situacao = validar_coordenadas(parte, self.corrigir_invertidas)
+            contagem = situacao.value_counts(sort=False)
+        self.situacoes.update({nome: int(n) for nome, n in contagem.items() if n})
+        for nome, n in contagem.items():
+            if n:
+                self.metricas.contar(f"coordenadas_{nome}_total", int(n))
+        invalidas = len(parte) - int(contagem["valida"] + contagem["corrigida"])
+        if invalidas or contagem["corrigida"] or virgula:
+            detalhes = [f"{int(n)} {SITUACOES_COORDENADA[nome]}" for nome, n in contagem.items() if n]
+            if virgula:
+                detalhes.append(f"{virgula} com vírgula decimal convertida")
+            acao = "retiradas da saída" if self.validacao == "rejeitar" else "marcadas e não geocodificadas"
+            prefixo = f"Parte {numero}: validação" if self.streaming else "Validação"
+            self.log(f"{prefixo} das coordenadas: {', '.join(detalhes)}"
+                     + (f" ({invalidas} inválidas {acao})." if invalidas else "."))
+        if self.validacao == "rejeitar":
+            return parte[situacao.isin(["valida", "corrigida"]).to_numpy()]
+        parte[COLUNA_VALIDACAO] = situacao
+        return parte
+
+    def processar_parte(self, parte, numero):
+        """
+        Deduplica as coordenadas válidas da parte, geocodifica as que ainda não têm resultado
+        e replica os resultados para todas as linhas da parte.
+        """
+        validas = None
+        if self.validacao == "marcar":
+            validas = parte[COLUNA_VALIDACAO].isin(["valida", "corrigida"])
+        with self.metricas.medir("deduplicacao"):
+            chaves, unicos = chaves_coordenadas(parte, self.precisao, validas)
+        self.resultados_parte = {}
+        reaproveitados = 0
+        if self.anterior is not None:
+            with self.metricas.medir("saida_anterior"):
+                for coordenada, resultado in self.anterior.reaproveitaveis(parte, chaves, self.resultados):
+                    self.guardar_resultado(coordenada, resultado)
+                    reaproveitados += 1
+            self.metricas.contar("saida_anterior_reaproveitadas_total", reaproveitados)
+        with self.metricas.medir("deduplicacao"):
+            # Copia para a parte os resultados já conhecidos; o mapa compartilhado pode perder
+            # a chave depois daqui sem afetar esta parte
+            conhecidos = []
+            for chave in zip(unicos["_lat"], unicos["_lon"]):
+                resultado = self.resultados_parte.get(chave)
+                if resultado is None:
+                    resultado = self.resultados.get(chave)
+                if resultado is not None:
+                    self.resultados_parte[chave] = resultado
+                conhecidos.append(resultado is not None)
+            novos = unicos[~np.array(conhecidos, dtype=bool)].reset_index(drop=True)
+            if self.ordem_espacial:
+                novos = ordenar_espacialmente(novos)
+        sem_coordenadas = int(chaves.isna().any(axis=1).sum())
+        anteriores = f", {reaproveitados} reaproveitadas da saída anterior" if self.anterior is not None else ""
+        if self.streaming:
+            self.log(f"Parte {numero}: {len(parte)} linhas, {len(novos)} coordenadas novas{anteriores}.")
+        else:
+            self.total_lines = len(novos)
+            self.log(f"{len(parte)} linhas, {len(novos)} coordenadas únicas a geocodificar{anteriores} "
+                     f"({sem_coordenadas} linhas sem coordenadas válidas serão ignoradas).")
+
+        try:
+            if self.malha is not None:
+                self.geocodificar_offline(novos)
+            else:
+                self.geocodificar_online(novos)
+                self.reprocessar_falhas()
+        finally:
+            with self.metricas.medir("enriquecimento_ibge"):
+                sem_ibge = aplicar_resultados(parte, chaves, self.resultados_parte, self.indice)
+            self.metricas.contar("ibge_sem_correspondencia_total", sem_ibge)
+
+    def geocodificar_online(self, unicos):
+        resolver = partial(self.resolver_coordenada, cache=self.cache, limitador=self.limitador,
+                           sessao=self.sessao, user_agent=self.user_agent, url_nominatim=self.url_nominatim,
+                           disjuntor=self.disjuntor, timeout=self.timeout)
+        pendentes = set()
+        seguidos = {}  # consultas de outros trabalhos da fila aguardadas por este -> (idx, lat, lon)
+        try:
+            for idx, lat, lon in unicos.itertuples(name=None):
+                self.pause_flag.wait()  # aguarda retomar se pausado
+
+                if self.cancel_flag.is_set():
+                    self.log("Processamento cancelado pelo usuário.")
+                    break
+
+                if self.casas_celula is not None:
+                    resultado = self.celulas.get(self.celula(lat, lon))
+                    if resultado is not None:
+                        # Tolerância aceita pelo usuário: mesmo município de um ponto já resolvido na célula
+                        self.metricas.contar("reuso_celula_total")
+                        self.registrar_resultado(idx, lat, lon, resultado)
+                        continue
+
+                tarefa = resolver
+                if self.compartilhado:
+                    # Na fila, a coordenada que outro trabalho já está consultando não é pedida de novo
+                    futuro, dono = self.compartilhado.reservar((lat, lon))
+                    if not dono:
+                        self.metricas.contar("fila_consultas_aguardadas_total")
+                        seguidos[futuro] = (idx, lat, lon)
+                        pendentes.add(futuro)
+                        continue
+                    tarefa = partial(self.resolver_reservado, resolver)
+
+                # Limita as requisições em voo ao número de workers
+                while len(pendentes) - len(seguidos) >= self.workers:
+                    concluidos, pendentes = wait(pendentes, return_when=FIRST_COMPLETED)
+                    self.coletar_resultados(concluidos, seguidos)
+                pendentes.add(self.executor.submit(tarefa, idx, lat, lon))
+        finally:
+            concluidos, _ = wait(pendentes)
+            self.coletar_resultados(concluidos, seguidos)
+
+    def resolver_reservado(self, resolver, idx, lat, lon):
+        """
+        Resolve uma coordenada reservada na fila e entrega o resultado aos trabalhos que a
+        aguardam (em caso de erro eles recebem uma falha a repetir).
+        """
+        retorno = (idx, lat, lon, None, True)
+        try:
+            retorno = resolver(idx, lat, lon)
+            return retorno
+        finally:
+            self.compartilhado.concluir((lat, lon), *retorno[3:])
+
+    def resolver_coordenada(self, idx, lat, lon, cache, limitador, sessao, user_agent, url_nominatim,
+                            disjuntor=None, timeout=10):
+        """
+        Geocodifica uma coordenada única (executado nos workers).
+        Retorna (idx, lat, lon, (cidade, estado, uf), repetir), com None no lugar do resultado
+        quando não há endereço e repetir=True quando a falha foi de rede/servidor.
+        Os dados do IBGE são anexados depois, por parte, em aplicar_resultados.
+        """
+        self.pause_flag.wait()
+        if self.cancel_flag.is_set():
+            return idx, lat, lon, None, False
+
+        metricas = self.metricas
+        endereco = None
+        if cache:
+            with metricas.medir("cache"):
+                endereco = cache.obter(lat, lon)
+            if endereco is not None:
+                metricas.contar("cache_acertos_total")
+        if endereco is None:
+            inicio = time.perf_counter()
+            try:
+                endereco = geocodificar_reversa(lat, lon, user_agent, url_nominatim, limitador, sessao,
+                                                disjuntor, timeout)
+            except CircuitoAberto:
+                # Recusada pelo disjuntor sem sair da máquina: não conta como requisição
+                metricas.contar("disjuntor_recusas_total")
+                return idx, lat, lon, None, True
+            metricas.observar("nominatim", time.perf_counter() - inicio)
+            if cache:
+                metricas.contar("cache_falhas_total")
+            metricas.contar("nominatim_requisicoes_total")
+            if endereco is None:
+                metricas.contar("nominatim_falhas_total")
+            else:
+                if not endereco:
+                    metricas.contar("nominatim_vazios_total")
+                if cache:
+                    with metricas.medir("cache"):
+                        cache.gravar(lat, lon, endereco)
+        if not endereco:
+            return idx, lat, lon, None, endereco is None
+
+        cidade = (endereco.get("city") or endereco.get("town") or endereco.get("village") or
+                  endereco.get("cidade") or "")
+        estado = (endereco.get("state_code") or endereco.get("state") or endereco.get("estado") or "")
+
+        uf = sigla_uf(endereco.get("ISO3166-2-lvl4")) or sigla_uf(estado)
+        return idx, lat, lon, (cidade, estado, uf), False
+
+    def coletar_resultados(self, concluidos, seguidos=None):
+        """
+        Registra os resultados dos workers, na ordem em que terminaram. Os futuros em `seguidos`
+        são consultas de outros trabalhos da fila e trazem só (resultado, repetir).
+        """
+        for futuro in concluidos:
+            if seguidos and futuro in seguidos:
+                idx, lat, lon = seguidos.pop(futuro)
+                self.registrar_resultado(idx, lat, lon, *futuro.result())
+            else:
+                self.registrar_resultado(*futuro.result())
+
+    def registrar_resultado(self, idx, lat, lon, resultado, repetir=False):
+        if resultado is None:
+            if self.cancel_flag.is_set():
+                return
+            if repetir:
+                # Erro de rede/servidor: a coordenada volta depois da passada principal
+                self.adiadas.append((idx, lat, lon))
+                if self.log_por_linha:
+                    self.log(f"[{idx}] Falha na geocodificação reversa ({lat}, {lon}); nova tentativa adiada.")
+            else:
+                self.falhas += 1
+                if self.log_por_linha:
+                    self.log(f"[{idx}] Sem endereço para ({lat}, {lon}).")
+                    print(f"Coordenada {idx} - sem localização")  # mensagem no terminal
+        else:
+            cidade, estado, uf = resultado
+            if self.log_por_linha:
+                if cidade and estado:
+                    self.log(f"[{idx}] {cidade}, {estado} ({uf or '?'})")
+                else:
+                    self.log(f"[{idx}] Cidade/Estado não encontrados para ({lat}, {lon})")
+                print(f"Coordenada {idx} - Cidade: {cidade} - Estado: {estado}")
+            self.guardar_resultado((lat, lon), resultado)
+            if self.primeiro_resultado is None:
+                self.registrar_primeiro_resultado()
+            if self.casas_celula is not None and cidade:
+                self.celulas.setdefault(self.celula(lat, lon), resultado)
+
+        if not self.streaming and not self.em_retentativa:
+            with self.lock:
+                self.processed_lines += 1
+            self.progresso()
+
+    def guardar_resultado(self, chave, resultado):
+        """
+        Registra o resultado de uma coordenada na parte atual, no mapa compartilhado e no diário.
+        """
+        self.resultados_parte[chave] = resultado
+        self.resultados[chave] = resultado
+        if self.streaming:
+            self.chaves_proprias.append(chave)
+        self.diario.registrar(chave, resultado)
+
+    def reprocessar_falhas(self):
+        """
+        Repete, depois da passada principal, as coordenadas que falharam por erro de rede ou
+        servidor, em rodadas com espera exponencial e jitter (e nunca antes de o disjuntor
+        liberar o endpoint). As que continuam falhando ficam sem resultado.
+        """
+        maximo = max(self.config_numero("retentativas", int), 0)
+        base = max(self.config_numero("retentativa_espera_segundos"), 0.0)
+        pendentes, self.adiadas = self.adiadas, []
+        rodada = 0
+        self.em_retentativa = True
+        try:
+            while pendentes and rodada < maximo and not self.cancel_flag.is_set():
+                rodada += 1
+                espera = base * 2 ** (rodada - 1) * random.uniform(0.5, 1.5)
+                espera = max(espera, self.disjuntor.segundos_ate_liberar())
+                self.log(f"Tentativa {rodada}/{maximo} para {len(pendentes)} coordenadas com falha "
+                         f"em {espera:.1f}s.")
+                if self.cancel_flag.wait(espera):
+                    break
+                lote = pd.DataFrame({"_lat": [lat for _, lat, _ in pendentes],
+                                     "_lon": [lon for _, _, lon in pendentes]},
+                                    index=[idx for idx, _, _ in pendentes])
+                if self.disjuntor.aberto:
+                    # Com o endpoint suspenso só passa uma requisição de teste: ela vai sozinha e
+                    # o resto da rodada só é enviado se o disjuntor fechar
+                    self.metricas.contar("retentativas_total")
+                    self.geocodificar_online(lote.iloc[:1])
+                    if self.disjuntor.aberto:
+                        pendentes, self.adiadas = self.adiadas + pendentes[1:], []
+                        continue
+                    lote = lote.iloc[1:]
+                self.metricas.contar("retentativas_total", len(lote))
+                self.geocodificar_online(lote)
+                pendentes, self.adiadas = self.adiadas, []
+        finally:
+            self.em_retentativa = False
+        if pendentes and not self.cancel_flag.is_set():
+            self.falhas += len(pendentes)
+            self.log(f"{len(pendentes)} coordenadas continuam com falha após {rodada} tentativa(s).")
+
+    def registrar_primeiro_resultado(self):
+        self.primeiro_resultado = time.time() - self.tempo_inicio
+        self.metricas.definir("primeiro_resultado_segundos", round(self.primeiro_resultado, 3))
+        self.log(f"Primeiro resultado em {self.primeiro_resultado:.2f}s.")
+
+    def geocodificar_offline(self, unicos):
+        """
+        Geocodificação reversa sem rede: localiza cada coordenada nas malhas municipais do IBGE.
+        """
+        latitudes = unicos["_lat"].to_numpy(dtype=float)
+        longitudes = unicos["_lon"].to_numpy(dtype=float)
+        bloco = 100_000
+        nao_encontrados = 0
+
+        for inicio in range(0, len(unicos), bloco):
+            if self.cancel_flag.is_set():
+                self.log("Processamento cancelado pelo usuário.")
+                break
+            self.pause_flag.wait()
+
+            fim = min(inicio + bloco, len(unicos))
+            with self.metricas.medir("malha"):
+                codigos = self.malha.localizar(latitudes[inicio:fim], longitudes[inicio:fim])
+            self.metricas.contar("malha_sem_municipio_total", int(np.count_nonzero(codigos == 0)))
+            tabela = {}
+            for codigo in np.unique(codigos):
+                dados = self.indice.por_codigo.get(int(codigo), DADOS_IBGE_VAZIOS)
+                # cidade/estado recebem o nome do município e da UF
+                tabela[codigo] = (dados[0], dados[4], dados[6])
+            for lat, lon, codigo in zip(latitudes[inicio:fim].tolist(), longitudes[inicio:fim].tolist(), codigos):
+                if codigo:
+                    self.guardar_resultado((lat, lon), tabela[codigo])
+            nao_encontrados += int(np.count_nonzero(codigos == 0))
+            if self.primeiro_resultado is None and tabela:
+                self.registrar_primeiro_resultado()
+
+            if not self.streaming:
+                with self.lock:
+                    self.processed_lines = fim
+                self.progresso()
+
+        if nao_encontrados:
+            self.log(f"{nao_encontrados} coordenadas fora das malhas municipais.")
+
+    def finalizar_processamento(self):
+        """
+        Grava a saída (fora do modo streaming). Retorna False se a gravação falhou.
+        """
+        salvo = self.salvar_resultado() if not self.streaming else True
+        self.log("Processamento finalizado.")
+        return salvo
+
+    def caminho_saida(self):
+        formato = self.configs.get("formato_saida", "xlsx").lower()
+        output_path = self.configs.get("output", DEFAULT_CONFIGS["output"])
+        return caminho_saida(output_path, formato, em_partes=self.streaming)
+
+    def salvar_resultado(self):
+        formato = self.configs.get("formato_saida", "xlsx").lower()
+        output_path = self.caminho_saida()
+
+        try:
+            with self.metricas.medir("escrita"):
+                escritor = EscritorSaida(output_path, formato)
+                try:
+                    escritor.escrever(self.df)
+                finally:
+                    escritor.fechar()
+
+            self.log(f"Arquivo salvo em: {output_path}")
+            return True
+        except Exception as e:
+            self.log(f"Erro ao salvar arquivo: {e}")
+            self.erro(f"Erro ao salvar arquivo:\n{e}")
+            return False
+
+
+SUFIXO_SAIDA_FILA = "_ibge"  # nome da saída de cada arquivo da fila: <entrada>_ibge.<formato>
+
+
+def listar_entradas(caminhos):
+    """
+    Expande a lista de entradas: pastas viram os arquivos suportados que contêm (sem subpastas),
+    ignorando as saídas de filas anteriores. Aceita também caminhos separados por ";".
+    """
+    if isinstance(caminhos, str):
+        caminhos = caminhos.split(";")
+    entradas = []
+    for caminho in (c.strip() for c in caminhos):
+        if not caminho:
+            continue
+        if os.path.isdir(caminho):
+            for nome in sorted(os.listdir(caminho)):
+                base, extensao = os.path.splitext(nome)
+                if extensao.lower() in EXTENSOES_ENTRADA and not base.endswith(SUFIXO_SAIDA_FILA):
+                    entradas.append(os.path.join(caminho, nome))
+        else:
+            entradas.append(caminho)
+    return entradas
+
+
+class RecursosCompartilhados:
+    """
+    Estado compartilhado pelos trabalhos de uma fila: o limitador de taxa global, os resultados
+    por coordenada, as consultas em andamento e, criados pelo primeiro trabalho que precisar, o
+    cache de geocodificação e as malhas municipais. O índice do IBGE já é único por execução
+    (obter_indice_municipios).
+    """
+
+    def __init__(self, configs, cancelar=None):
+        self.limitador = LimitadorTaxa(config_numero(configs, "requisicoes_por_segundo"),
+                                       config_numero(configs, "rajada", int), cancelar)
+        self.resultados = {}
+        self.em_voo = {}  # coordenada -> Future com (resultado, repetir) da consulta em andamento
+        self.lock_em_voo = threading.Lock()
+        self.cache = None
+        self.malha = None
+        self.lock = threading.Lock()
+
+    def reservar(self, chave):
+        """
+        Reserva a consulta de uma coordenada. Retorna (futuro, dono): com dono=True a consulta
+        cabe a quem chamou, que a encerra com concluir(); senão o futuro é o da consulta que já
+        está em andamento (ou já terminou) em outro trabalho.
+        """
+        with self.lock_em_voo:
+            futuro = self.em_voo.get(chave)
+            if futuro is not None:
+                return futuro, False
+            futuro = Future()
+            resultado = self.resultados.get(chave)
+            if resultado is not None:
+                futuro.set_result((resultado, False))
+                return futuro, False
+            self.em_voo[chave] = futuro
+            return futuro, True
+
+    def concluir(self, chave, resultado, repetir=False):
+        with self.lock_em_voo:
+            futuro = self.em_voo.pop(chave, None)
+            if resultado is not None:
+                self.resultados[chave] = resultado
+        if futuro is not None:
+            futuro.set_result((resultado, repetir))
+
+    def obter(self, nome, criar):
+        with self.lock:
+            if getattr(self, nome) is None:
+                setattr(self, nome, criar())
+            return getattr(self, nome)
+
+    def fechar(self):
+        if self.cache is not None:
+            self.cache.fechar()
+            self.cache = None
+
+
+class FilaProcessamento:
+    """
+    Processa vários arquivos de entrada, um após o outro ou `paralelos` de cada vez, sob um único
+    limitador de taxa e com resultados, cache e índice do IBGE compartilhados: cada coordenada
+    única é consultada uma vez no conjunto, e não uma vez por arquivo.
+    """
+
+    def __init__(self, configs, entradas, pasta_saida=None, paralelos=1, ao_log=None, ao_progresso=None,
+                 ao_status=None, ao_erro=None, pause_flag=None, cancel_flag=None):
+        self.configs = configs
+        self.entradas = list(entradas)
+        self.pasta_saida = pasta_saida
+        self.paralelos = max(int(paralelos), 1)
+        self.ao_log = ao_log or print
+        self.ao_progresso = ao_progresso
+        self.ao_status = ao_status
+        self.ao_erro = ao_erro
+        self.pause_flag = pause_flag or threading.Event()
+        if pause_flag is None:
+            self.pause_flag.set()
+        self.cancel_flag = cancel_flag or threading.Event()
+        self.compartilhado = None
+        self.resumos = []
+        self.progressos = {}
+        self.lock = threading.Lock()
+
+    @property
+    def processed_lines(self):
+        return sum(p for p, _ in self.progressos.values())
+
+    @property
+    def total_lines(self):
+        return sum(t for _, t in self.progressos.values())
+
+    def caminho_saida(self, entrada):
+        base = os.path.splitext(os.path.basename(entrada))[0] + SUFIXO_SAIDA_FILA
+        return os.path.join(self.pasta_saida or os.path.dirname(entrada), base)
+
+    def registrar_progresso(self, entrada, processados, total, restante=None):
+        with self.lock:
+            self.progressos[entrada] = (processados, total)
+            processados = sum(p for p, _ in self.progressos.values())
+            total = sum(t for _, t in self.progressos.values())
+        if self.ao_progresso:
+            self.ao_progresso(processados, total, None)
+
+    def executar_trabalho(self, numero, entrada):
+        nome = os.path.basename(entrada)
+        if self.cancel_flag.is_set():
+            return dict(arquivo=nome, status="cancelado", linhas=0, consultas=0, segundos=0.0)
+        configs = dict(self.configs, input_csv=entrada, output=self.caminho_saida(entrada))
+        if configs.get("saida_anterior") and os.path.isdir(configs["saida_anterior"]):
+            # Cada arquivo da fila procura a própria saída anterior (<nome>_ibge) na pasta
+            configs["saida_anterior"] = localizar_saida_anterior(configs["saida_anterior"],
+                                                                 os.path.basename(configs["output"]))
+        if configs.get("metricas_arquivo"):
+            base, extensao = os.path.splitext(configs["metricas_arquivo"])
+            configs["metricas_arquivo"] = f"{base}_{os.path.splitext(nome)[0]}{extensao}"
+        self.ao_log(f"[{numero}/{len(self.entradas)}] Iniciando {nome}")
+        motor = MotorGeocodificacao(
+            configs,
+            ao_log=lambda msg: self.ao_log(f"[{nome}] {msg}"),
+            ao_progresso=partial(self.registrar_progresso, entrada),
+            ao_erro=(lambda msg: self.ao_erro(f"{nome}: {msg}")) if self.ao_erro else None,
+            pause_flag=self.pause_flag,
+            cancel_flag=self.cancel_flag,
+            compartilhado=self.compartilhado,
+        )
+        inicio = time.monotonic()
+        try:
+            concluido = motor.executar()
+        except Exception as e:
+            self.ao_log(f"[{nome}] Erro: {e}")
+            concluido = False
+        segundos = time.monotonic() - inicio
+        if motor.streaming:
+            linhas = motor.processed_lines
+        else:
+            linhas = len(motor.df) if concluido and motor.df is not None else 0
+        if concluido:
+            status = "concluído"
+        else:
+            status = "cancelado" if self.cancel_flag.is_set() else "erro"
+        return dict(arquivo=nome, status=status, linhas=linhas, segundos=round(segundos, 2),
+                    consultas=motor.metricas.contadores.get("nominatim_requisicoes_total", 0),
+                    saida=motor.caminho_saida())
+
+    def executar(self):
+        """
+        Executa a fila. Retorna True se todos os arquivos foram concluídos.
+        """
+        carregar_modulos_tardios()  # antes de abrir as threads dos trabalhos
+        self.compartilhado = RecursosCompartilhados(self.configs, self.cancel_flag)
+        self.resumos = []
+        inicio = time.monotonic()
+        self.ao_log(f"Fila com {len(self.entradas)} arquivos, {self.paralelos} por vez.")
+        if self.ao_status:
+            self.ao_status("Status: Processando fila...")
+        try:
+            if self.paralelos == 1:
+                for numero, entrada in enumerate(self.entradas, start=1):
+                    self.resumos.append(self.executar_trabalho(numero, entrada))
+            else:
+                with ThreadPoolExecutor(max_workers=self.paralelos) as executor:
+                    futuros = [executor.submit(self.executar_trabalho, numero, entrada)
+                               for numero, entrada in enumerate(self.entradas, start=1)]
+                    self.resumos = [futuro.result() for futuro in futuros]
+        finally:
+            cache = self.compartilhado.cache
+            if cache is not None:
+                self.ao_log(f"Cache de geocodificação: {cache.acertos} acertos, {cache.falhas} falhas.")
+            self.compartilhado.fechar()
+
+        self.ao_log("Resumo da fila:")
+        for resumo in self.resumos:
+            taxa = resumo["linhas"] / resumo["segundos"] if resumo["segundos"] else 0.0
+            self.ao_log(f"  {resumo['arquivo']}: {resumo['status']}, {resumo['linhas']} linhas em "
+                        f"{formatar_tempo(resumo['segundos'])} ({taxa:.1f} linhas/s), "
+                        f"{resumo['consultas']} consultas ao Nominatim")
+        total_linhas = sum(r["linhas"] for r in self.resumos)
+        self.ao_log(f"Total: {total_linhas} linhas em {formatar_tempo(time.monotonic() - inicio)}, "
+                    f"{len(self.compartilhado.resultados)} coordenadas únicas, "
+                    f"{sum(r['consultas'] for r in self.resumos)} consultas.")
+        concluido = all(r["status"] == "concluído" for r in self.resumos)
+        if concluido and self.ao_status:
+            self.ao_status("Status: Finalizado")
+        return concluido
+
+
+INTERVALO_UI_MS = 150  # intervalo de atualização da interface
+MAX_LINHAS_LOG = 1000  # linhas mantidas no log da interface
+
+
+class App(JanelaBase):
     def __init__(self):
         super().__init__()
         self.title("Geocodificação IBGE")
-        self.geometry("750x600")  # aumentei a altura para o radio buttons
-        self.resizable(False, False)
+        self.geometry("750x680")  # a aba de configurações rola; a janela pode ser redimensionada
+        self.minsize(750, 600)
 
         self.configs = load_configs()
         self.config_entries = {}
@@ -139,7 +2721,10 @@ class App(tk.Tk):
         self.cancel_flag = threading.Event()
         self.cancel_flag.clear()
 
-        self.tempo_inicio = None  # para calcular tempo estimado
+        self.motor = None
+        self.fila_eventos = queue.Queue()
+        self.ultimo_progresso = None  # só o progresso mais recente é desenhado
+        self.buffer_log = deque(maxlen=MAX_LINHAS_LOG)
 
         self.create_widgets()
         try:
@@ -150,6 +2735,18 @@ class App(tk.Tk):
             print(f"Falha ao carregar ícone: {e}")
 
         self.update_bolinha("red")
+        self.after(INTERVALO_UI_MS, self.drenar_eventos)
+        self.aquecimento = None
+        self.after_idle(self.janela_pronta)
+
+    def janela_pronta(self):
+        """
+        Chamado quando a janela termina de ser desenhada: registra o tempo de abertura e
+        começa o aquecimento enquanto o usuário escolhe o arquivo.
+        """
+        self.log(f"Janela pronta em {time.perf_counter() - INICIO_PROGRAMA:.2f}s.")
+        self.aquecimento = threading.Thread(target=aquecer, args=(dict(self.configs), self.log), daemon=True)
+        self.aquecimento.start()
 
     def create_widgets(self):
         notebook = ttk.Notebook(self)
@@ -174,7 +2771,7 @@ class App(tk.Tk):
         self.btn_cancelar = ttk.Button(frame_botoes, text="Cancelar", command=self.cancelar_processamento, state="disabled")
         self.btn_cancelar.pack(side=tk.LEFT, padx=5)
 
-        self.btn_load = ttk.Button(frame_botoes, text="Selecionar arquivo CSV/XLSX", command=self.selecionar_arquivo)
+        self.btn_load = ttk.Button(frame_botoes, text="Selecionar arquivo de entrada", command=self.selecionar_arquivo)
         self.btn_load.pack(side=tk.LEFT, padx=20)
 
         self.label_status = ttk.Label(frame_controle, text="Status: Aguardando arquivo...")
@@ -187,7 +2784,7 @@ class App(tk.Tk):
         self.label_tempo_estimado = ttk.Label(frame_controle, text="Tempo estimado restante: N/A")
         self.label_tempo_estimado.pack(fill=tk.X, padx=10, pady=2)
 
-        self.text_log = tk.Text(frame_controle, height=15, state="normal")
+        self.text_log = tk.Text(frame_controle, height=10, state="normal")  # cresce com a janela
         self.text_log.pack(fill=tk.BOTH, padx=10, pady=5, expand=True)
         
         footer_text = "Desenvolvido por Thiago Barros | Versão 1.0 | © 2025"
@@ -202,25 +2799,97 @@ class App(tk.Tk):
         formatos = [("Excel (.xlsx)", "xlsx"),
                     ("CSV (.csv)", "csv"),
                     ("JSON (.json)", "json"),
-                    ("SQLite (.sql)", "sql")]
+                    ("SQLite (.sql)", "sql"),
+                    ("Parquet (.parquet)", "parquet"),
+                    ("Feather (.feather)", "feather")]
 
         for text, val in formatos:
             rb = ttk.Radiobutton(frame_formato, text=text, variable=self.formato_saida_var, value=val)
-            rb.pack(side=tk.LEFT, padx=10, pady=5)
+            rb.pack(side=tk.LEFT, padx=6, pady=5)
+
+        frame_modo = ttk.LabelFrame(frame_controle, text="Modo de geocodificação")
+        frame_modo.pack(fill=tk.X, padx=10, pady=5)
+
+        self.modo_var = tk.StringVar(value=self.configs.get("modo_geocodificacao", "nominatim"))
+
+        modos = [("Nominatim (online)", "nominatim"),
+                 ("Malhas IBGE (offline)", "offline")]
+
+        frame_fontes = ttk.Frame(frame_modo)
+        frame_fontes.pack(fill=tk.X)
+        for text, val in modos:
+            rb = ttk.Radiobutton(frame_fontes, text=text, variable=self.modo_var, value=val)
+            rb.pack(side=tk.LEFT, padx=6, pady=5)
+
+        # Opções em grade própria, abaixo dos modos, para não cortar na largura da janela
+        frame_opcoes = ttk.Frame(frame_modo)
+        frame_opcoes.pack(fill=tk.X)
+
+        self.streaming_var = tk.BooleanVar(value=self.configs.get("modo_streaming", "0") == "1")
+        self.log_linha_var = tk.BooleanVar(value=self.configs.get("log_por_linha", "0") == "1")
+        self.ordem_espacial_var = tk.BooleanVar(value=self.configs.get("ordem_espacial", "0") == "1")
+        self.corrigir_invertidas_var = tk.BooleanVar(value=self.configs.get("corrigir_invertidas", "0") == "1")
+
+        opcoes = [("Streaming (arquivos grandes)", self.streaming_var),
+                  ("Log por linha", self.log_linha_var),
+                  ("Ordem espacial", self.ordem_espacial_var),
+                  ("Corrigir lat/lon invertidas", self.corrigir_invertidas_var)]
+
+        for i, (text, var) in enumerate(opcoes):
+            cb = ttk.Checkbutton(frame_opcoes, text=text, variable=var)
+            cb.grid(row=i // 2, column=i % 2, sticky=tk.W, padx=6, pady=3)
         # ----------------------------------
 
-        frame_config = ttk.Frame(notebook)
-        notebook.add(frame_config, text="Configurações")
+        # A aba de configurações é maior que a janela: fica dentro de um canvas com barra de rolagem
+        aba_config = ttk.Frame(notebook)
+        notebook.add(aba_config, text="Configurações")
+
+        canvas_config = tk.Canvas(aba_config, highlightthickness=0)
+        barra_config = ttk.Scrollbar(aba_config, orient=tk.VERTICAL, command=canvas_config.yview)
+        canvas_config.configure(yscrollcommand=barra_config.set)
+        barra_config.pack(side=tk.RIGHT, fill=tk.Y)
+        canvas_config.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        frame_config = ttk.Frame(canvas_config)
+        janela_config = canvas_config.create_window((0, 0), window=frame_config, anchor=tk.NW)
+        frame_config.bind("<Configure>",
+                          lambda e: canvas_config.configure(scrollregion=canvas_config.bbox("all")))
+        canvas_config.bind("<Configure>", lambda e: canvas_config.itemconfigure(janela_config, width=e.width))
+        self.canvas_config = canvas_config
+        # A roda do mouse só rola a aba enquanto o ponteiro está sobre ela
+        canvas_config.bind("<Enter>", lambda e: self.ligar_rolagem_config(True))
+        canvas_config.bind("<Leave>", lambda e: self.ligar_rolagem_config(False))
 
         linhas = [
             ("Pasta Temp", "pasta_temp"),
-            ("Arquivo Entrada (CSV/XLSX)", "input_csv"),
+            ("Arquivo Entrada (CSV/XLSX/Parquet/Feather)", "input_csv"),
+            ("Arquivos processados ao mesmo tempo (fila)", "trabalhos_paralelos"),
             ("Arquivo Saída", "output"),
-            ("Batch Size (linhas por lote)", "batch_size"),
-            ("Delay entre lotes (segundos)", "delay_segundos"),
+            ("Saída anterior (modo incremental)", "saida_anterior"),
+            ("Coluna-chave do modo incremental", "chave_incremental"),
+            ("Validação das coordenadas (marcar/rejeitar/desligada)", "validacao_coordenadas"),
+            ("Precisão das coordenadas (casas decimais)", "precisao_coordenadas"),
+            ("Reaproveitar município na célula (casas decimais)", "reuso_celula_casas"),
+            ("Requisições por segundo", "requisicoes_por_segundo"),
+            ("Rajada (requisições seguidas)", "rajada"),
+            ("Workers (requisições simultâneas)", "workers"),
+            ("Timeout das requisições (segundos)", "timeout_segundos"),
+            ("Novas tentativas para falhas", "retentativas"),
+            ("Espera inicial entre tentativas (segundos)", "retentativa_espera_segundos"),
+            ("Falhas seguidas para suspender o endpoint", "disjuntor_falhas"),
+            ("Suspensão do endpoint (segundos)", "disjuntor_segundos"),
+            ("Linhas por parte (modo streaming)", "tamanho_parte"),
+            ("Intervalo do checkpoint (segundos)", "checkpoint_segundos"),
+            ("Arquivo de métricas (.json ou .prom)", "metricas_arquivo"),
+            ("Intervalo das métricas (segundos)", "metricas_segundos"),
             ("User-Agent (Nominatim)", "user_agent"),
             ("URL da API do IBGE", "api_ibge_url"),
             ("URL da API do Nominatim", "api_nominatim_url"),
+            ("URL das malhas do IBGE", "api_malhas_url"),
+            ("Validade cache IBGE (horas)", "ibge_ttl_horas"),
+            ("Precisão do cache (casas decimais)", "cache_precisao"),
+            ("Máximo de entradas no cache", "cache_max_entradas"),
+            ("Validade cache geocodificação (dias)", "cache_ttl_dias"),
         ]
 
         for i, (label_text, key) in enumerate(linhas):
@@ -235,34 +2904,127 @@ class App(tk.Tk):
 
         legenda_texto = (
             "Legenda:\n"
-            "- Pasta Temp: pasta para arquivos temporários (não obrigatória).\n"
-            "- Arquivo Entrada: arquivo CSV ou XLSX contendo colunas 'latitude' e 'longitude'.\n"
+            "- Pasta Temp: pasta para arquivos temporários e caches (não obrigatória).\n"
+            "- Arquivo Entrada: CSV, XLSX, Parquet ou Feather com colunas 'latitude' e 'longitude';\n"
+            "  as demais colunas são copiadas para a saída sem conversão. Uma pasta ou vários\n"
+            "  arquivos separados por ';' formam uma fila: cada um gera <nome>_ibge ao lado da entrada,\n"
+            "  com limite de taxa, cache e resultados compartilhados.\n"
+            "- Arquivos ao mesmo tempo: quantos arquivos da fila rodam em paralelo (1 = em sequência).\n"
             "- Arquivo Saída: nome do arquivo de saída.\n"
-            "- Batch Size: número de linhas processadas por vez.\n"
-            "- Delay entre lotes: segundos de espera entre cada lote para respeitar limites da API.\n"
+            "- Saída anterior: resultado de uma execução anterior (qualquer formato de saída); as linhas\n"
+            "  que não mudaram reaproveitam o resultado e só coordenadas novas ou alteradas são\n"
+            "  geocodificadas. Na fila, informe a pasta das saídas anteriores (vazio = desligado).\n"
+            "- Coluna-chave: casa as linhas pela coluna indicada, exigindo as mesmas coordenadas\n"
+            "  (vazio = casa só pelas coordenadas).\n"
+            "- Validação das coordenadas: antes de qualquer consulta, coordenadas ausentes, fora do\n"
+            "  intervalo, em (0, 0), com lat/lon invertidas ou fora do Brasil não são geocodificadas;\n"
+            "  'marcar' indica a situação na coluna validacao_coordenada e 'rejeitar' retira as linhas\n"
+            "  da saída. Vírgula decimal ('-23,55') é aceita. 'Corrigir lat/lon invertidas' desinverte\n"
+            "  os pontos que, trocados, caem no Brasil.\n"
+            "- Precisão das coordenadas: agrupa coordenadas iguais até essa casa decimal antes de\n"
+            "  geocodificar (vazio = coordenadas exatas); cada coordenada única é consultada uma vez.\n"
+            "- Ordem espacial: geocodifica as coordenadas únicas na ordem de uma curva de Hilbert\n"
+            "  (vizinhas em sequência); a saída mantém a ordem original das linhas.\n"
+            "- Reaproveitar município na célula: pontos numa célula já resolvida (3 casas ~ 110 m)\n"
+            "  recebem o mesmo município sem nova consulta; aceita erro perto de divisas (vazio = desligado).\n"
+            "- Requisições por segundo: taxa máxima de consultas às APIs; diminui sozinha quando a API\n"
+            "  responde 429/503 e volta aos poucos ao valor configurado.\n"
+            "- Rajada: quantas requisições podem sair seguidas antes de respeitar a taxa.\n"
+            "- Workers: requisições simultâneas com conexões reaproveitadas (use > 1 só em Nominatim próprio).\n"
+            "- Novas tentativas: coordenadas que falharam por erro de rede/servidor são repetidas ao fim\n"
+            "  de cada parte, com espera que dobra a cada rodada (com variação aleatória).\n"
+            "- Falhas seguidas / suspensão: após tantas falhas seguidas o Nominatim deixa de ser chamado\n"
+            "  pelo tempo indicado (uma requisição de teste por intervalo), evitando esperar timeouts.\n"
+            "- Linhas por parte: no modo streaming o arquivo é lido, enriquecido e gravado em partes\n"
+            "  com uso de memória constante (JSON vira JSON Lines; Excel abre nova planilha a cada\n"
+            "  1.048.576 linhas). Parquet e Feather exigem o pacote pyarrow.\n"
+            "- Intervalo do checkpoint: a cada intervalo o progresso é gravado em <saída>.diario;\n"
+            "  rodar de novo o mesmo arquivo retoma do ponto em que parou.\n"
+            "- Arquivo de métricas: tempos por etapa e contadores (JSON ou texto do Prometheus),\n"
+            "  gravados a cada intervalo e ao fim da execução (vazio = não grava).\n"
             "- User-Agent: identificador para requisições Nominatim.\n"
             "- URL da API do IBGE: endpoint para consulta dos municípios.\n"
-            "- URL da API do Nominatim: endpoint para geocodificação reversa."
+            "- URL da API do Nominatim: endpoint para geocodificação reversa.\n"
+            "- URL das malhas do IBGE: malha municipal baixada para a Pasta Temp no modo offline.\n"
+            "- Validade cache IBGE: horas até renovar a lista de municípios salva na Pasta Temp (0 = nunca).\n"
+            "- Cache de geocodificação: coordenadas arredondadas na precisão indicada; as menos usadas\n"
+            "  são removidas acima do máximo de entradas (validade 0 = sem expiração)."
         )
         label_legenda = ttk.Label(frame_config, text=legenda_texto, justify=tk.LEFT, foreground="gray")
         label_legenda.grid(row=len(linhas), column=0, columnspan=2, sticky=tk.W, padx=5, pady=10)
 
+    def ligar_rolagem_config(self, ligar):
+        for evento in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            if ligar:
+                self.bind_all(evento, self.rolar_config)
+            else:
+                self.unbind_all(evento)
+
+    def rolar_config(self, event):
+        if event.num == 4:
+            passos = -1
+        elif event.num == 5:
+            passos = 1
+        else:
+            passos = -1 if event.delta > 0 else 1  # Windows/macOS
+        self.canvas_config.yview_scroll(passos, "units")
+
     def update_bolinha(self, cor):
         self.canvas_bolinha.itemconfig(self.bolinha_id, fill=cor)
 
     def log(self, msg):
         texto = f"[{time.strftime('%H:%M:%S')}] {msg}"
         print(texto)
-        self.text_log.config(state="normal")
-        self.text_log.insert(tk.END, texto + "\n")
-        self.text_log.see(tk.END)
-        self.text_log.config(state="disabled")
+        self.fila_eventos.put(("log", texto))
+
+    def drenar_eventos(self):
+        """
+        Aplica na interface os eventos enviados pela thread de processamento.
+        Roda no loop principal do Tk a cada INTERVALO_UI_MS; nenhuma outra thread toca nos widgets.
+        """
+        novas_linhas = []
+        try:
+            while True:
+                tipo, valor = self.fila_eventos.get_nowait()
+                if tipo == "log":
+                    novas_linhas.append(valor)
+                elif tipo == "status":
+                    self.label_status.config(text=valor)
+                elif tipo == "erro":
+                    messagebox.showerror("Erro", valor)
+                elif tipo == "fim":
+                    self.encerrar_processamento()
+        except queue.Empty:
+            pass
+
+        if novas_linhas:
+            self.buffer_log.extend(novas_linhas)
+            self.text_log.config(state="normal")
+            if len(novas_linhas) >= MAX_LINHAS_LOG:
+                self.text_log.delete("1.0", tk.END)
+                self.text_log.insert(tk.END, "\n".join(self.buffer_log) + "\n")
+            else:
+                self.text_log.insert(tk.END, "\n".join(novas_linhas) + "\n")
+                excedente = int(self.text_log.index("end-1c").split(".")[0]) - 1 - MAX_LINHAS_LOG
+                if excedente > 0:
+                    self.text_log.delete("1.0", f"{excedente + 1}.0")
+            self.text_log.see(tk.END)
+            self.text_log.config(state="disabled")
+
+        progresso, self.ultimo_progresso = self.ultimo_progresso, None
+        if progresso is not None:
+            self.atualizar_progresso(*progresso)
+
+        self.after(INTERVALO_UI_MS, self.drenar_eventos)
 
     def selecionar_arquivo(self):
-        caminho = filedialog.askopenfilename(
-            title="Selecione arquivo CSV ou XLSX",
-            filetypes=[("CSV files", "*.csv"), ("Excel files", "*.xlsx")]
+        caminhos = filedialog.askopenfilenames(
+            title="Selecione o(s) arquivo(s) de entrada",
+            filetypes=[("CSV files", "*.csv"), ("Excel files", "*.xlsx"),
+                       ("Parquet/Feather files", "*.parquet *.feather *.arrow")]
         )
+        # Vários arquivos formam uma fila, processada com caches compartilhados
+        caminho = ";".join(caminhos)
         if caminho:
             self.config_entries["input_csv"].delete(0, tk.END)
             self.config_entries["input_csv"].insert(0, caminho)
@@ -271,13 +3033,20 @@ class App(tk.Tk):
             self.btn_processar.config(state="normal")
             self.update_bolinha("blue")
 
-    def atualizar_progresso(self):
+    def atualizar_progresso(self, processados, total, restante=None):
+        self.processed_lines = processados
+        self.total_lines = total
         if self.total_lines > 0:
             perc = (self.processed_lines / self.total_lines) * 100
             self.progress_var.set(perc)
         else:
             self.progress_var.set(0)
-        self.update()
+        self.atualizar_tempo_estimado(restante)
+
+    def atualizar_tempo_estimado(self, tempo_restante):
+        if tempo_restante is None:
+            return
+        self.label_tempo_estimado.config(text=f"Tempo estimado restante: {formatar_tempo(tempo_restante)}")
 
     def toggle_pause(self):
         if self.pause_flag.is_set():
@@ -318,233 +3087,192 @@ class App(tk.Tk):
         self.text_log.config(state="normal")
         self.text_log.delete("1.0", tk.END)
         self.text_log.config(state="disabled")
+        self.buffer_log.clear()
 
         # Atualiza configs
         for chave, entry in self.config_entries.items():
             self.configs[chave] = entry.get()
-        # Salva também o formato de saída selecionado
+        # Salva também o formato de saída e o modo selecionados
         self.configs["formato_saida"] = self.formato_saida_var.get()
+        self.configs["modo_geocodificacao"] = self.modo_var.get()
+        self.configs["modo_streaming"] = "1" if self.streaming_var.get() else "0"
+        self.configs["log_por_linha"] = "1" if self.log_linha_var.get() else "0"
+        self.configs["ordem_espacial"] = "1" if self.ordem_espacial_var.get() else "0"
+        self.configs["corrigir_invertidas"] = "1" if self.corrigir_invertidas_var.get() else "0"
         save_configs(self.configs)
 
-        self.tempo_inicio = time.time()  # marca início do processamento
-
         thread = threading.Thread(target=self.processar_arquivo_entrada, daemon=True)
         thread.start()
 
-    def get_batch_size_delay(self):
-        try:
-            batch_size = int(self.configs.get("batch_size", DEFAULT_CONFIGS["batch_size"]))
-        except:
-            batch_size = int(DEFAULT_CONFIGS["batch_size"])
-
-        try:
-            delay = float(self.configs.get("delay_segundos", DEFAULT_CONFIGS["delay_segundos"]))
-        except:
-            delay = float(DEFAULT_CONFIGS["delay_segundos"])
-
-        return batch_size, delay
-
     def processar_arquivo_entrada(self):
-        caminho = self.configs.get("input_csv", "")
-        extensao = os.path.splitext(caminho)[1].lower()
-
-        try:
-            if extensao == ".csv":
-                self.df = pd.read_csv(caminho)
-            elif extensao == ".xlsx":
-                self.df = pd.read_excel(caminho)
-            else:
-                raise ValueError("Formato de arquivo não suportado.")
-        except Exception as e:
-            self.log(f"Erro ao carregar arquivo: {e}")
-            messagebox.showerror("Erro", f"Erro ao carregar arquivo:\n{e}")
-            self.btn_processar.config(state="normal")
-            self.btn_pause.config(state="disabled")
-            self.btn_cancelar.config(state="disabled")
-            return
-
-        if "latitude" not in self.df.columns or "longitude" not in self.df.columns:
-            messagebox.showerror("Erro", "O arquivo deve conter colunas chamadas 'latitude' e 'longitude'.")
-            self.btn_processar.config(state="normal")
-            self.btn_pause.config(state="disabled")
-            self.btn_cancelar.config(state="disabled")
-            return
-
-        # Criar colunas para dados IBGE
-        for col in ["cidade", "estado", "municipio_ibge", "codigo_ibge", "mesorregiao",
-                    "codigo_mesorregiao", "uf_nome", "uf_codigo", "uf_sigla"]:
-            self.df[col] = ""
-
-        self.total_lines = len(self.df)
-        self.processed_lines = 0
-        batch_size, delay = self.get_batch_size_delay()
-        user_agent = self.configs.get("user_agent", DEFAULT_CONFIGS["user_agent"])
-        url_ibge = self.configs.get("api_ibge_url", URL_IBGE)
-        url_nominatim = self.configs.get("api_nominatim_url", URL_NOMINATIM)
-
-        self.log(f"Iniciando processamento de {self.total_lines} linhas, batch {batch_size}, delay {delay}s.")
-        self.label_status.config(text="Status: Processando...")
-
+        """
+        Executa o motor na thread de processamento; a interface é atualizada só via fila de eventos.
+        """
+        def registrar_progresso(processados, total, restante=None):
+            self.ultimo_progresso = (processados, total, restante)
+
+        if self.aquecimento is not None:
+            self.aquecimento.join()  # o processamento começa com os módulos e o índice já prontos
+
+        callbacks = dict(
+            ao_log=self.log,
+            ao_progresso=registrar_progresso,
+            ao_status=lambda texto: self.fila_eventos.put(("status", texto)),
+            ao_erro=lambda msg: self.fila_eventos.put(("erro", msg)),
+            pause_flag=self.pause_flag,
+            cancel_flag=self.cancel_flag,
+        )
+        entrada = self.configs.get("input_csv", "")
+        entradas = listar_entradas(entrada)
+        if len(entradas) > 1 or os.path.isdir(entrada):
+            paralelos = self.configs.get("trabalhos_paralelos", "1")
+            self.motor = FilaProcessamento(self.configs, entradas,
+                                           paralelos=int(paralelos) if paralelos.isdigit() else 1, **callbacks)
+        else:
+            self.motor = MotorGeocodificacao(self.configs, **callbacks)
         try:
-            for start_idx in range(0, self.total_lines, batch_size):
-                if self.cancel_flag.is_set():
-                    self.log("Processamento cancelado pelo usuário.")
-                    break
-
-                self.pause_flag.wait()  # aguarda retomar se pausado
-
-                end_idx = min(start_idx + batch_size, self.total_lines)
-                batch = self.df.iloc[start_idx:end_idx]
-
-                for idx, row in batch.iterrows():
-                    self.pause_flag.wait()
-
-                    if self.cancel_flag.is_set():
-                        break
-
-                    lat = row.get("latitude")
-                    lon = row.get("longitude")
-
-                    if pd.isna(lat) or pd.isna(lon):
-                        self.log(f"[{idx}] Coordenadas ausentes. Pulando.")
-                        print(f"Linha {idx} - sem localização")  # mensagem no terminal
-                        with self.lock:
-                            self.processed_lines += 1
-                        self.atualizar_progresso()
-                        self.atualizar_tempo_estimado()
-                        continue
-
-                    endereco = geocodificar_reversa(lat, lon, user_agent, url_nominatim)
-                    if not endereco:
-                        self.log(f"[{idx}] Falha na geocodificação reversa ({lat}, {lon}).")
-                        print(f"Linha {idx} - sem localização")  # mensagem no terminal
-                        with self.lock:
-                            self.processed_lines += 1
-                        self.atualizar_progresso()
-                        self.atualizar_tempo_estimado()
-                        continue
-
-                    cidade = (endereco.get("city") or endereco.get("town") or endereco.get("village") or
-                              endereco.get("cidade") or "")
-                    estado = (endereco.get("state_code") or endereco.get("state") or endereco.get("estado") or "")
-
-                    self.df.at[idx, "cidade"] = cidade
-                    self.df.at[idx, "estado"] = estado
-
-                    if cidade and estado:
-                        dados_ibge = buscar_dados_ibge(cidade, estado[:2], url_ibge)
-                        (
-                            municipio_ibge,
-                            codigo_ibge,
-                            mesorregiao,
-                            codigo_mesorregiao,
-                            uf_nome,
-                            uf_codigo,
-                            uf_sigla,
-                        ) = dados_ibge
-
-                        self.df.at[idx, "municipio_ibge"] = municipio_ibge or ""
-                        self.df.at[idx, "codigo_ibge"] = codigo_ibge or ""
-                        self.df.at[idx, "mesorregiao"] = mesorregiao or ""
-                        self.df.at[idx, "codigo_mesorregiao"] = codigo_mesorregiao or ""
-                        self.df.at[idx, "uf_nome"] = uf_nome or ""
-                        self.df.at[idx, "uf_codigo"] = uf_codigo or ""
-                        self.df.at[idx, "uf_sigla"] = uf_sigla or ""
-
-                        self.log(f"[{idx}] {cidade}, {estado} -> {municipio_ibge} ({codigo_ibge})")
-                    else:
-                        self.log(f"[{idx}] Cidade/Estado não encontrados para ({lat}, {lon})")
-
-                    print(f"Linha {idx} - Cidade: {cidade} - Estado: {estado}")
-
-                    with self.lock:
-                        self.processed_lines += 1
-                    self.atualizar_progresso()
-                    self.atualizar_tempo_estimado()
-
-                if self.cancel_flag.is_set():
-                    break
-
-                # Delay com pausa respeitada
-                for _ in range(int(delay * 10)):
-                    if self.cancel_flag.is_set():
-                        break
-                    self.pause_flag.wait()
-                    time.sleep(0.1)
+            self.motor.executar()
+        finally:
+            self.df = getattr(self.motor, "df", None)
+            self.fila_eventos.put(("fim", None))
 
-            self.label_status.config(text="Status: Finalizado")
+    def encerrar_processamento(self):
+        self.btn_pause.config(state="disabled")
+        self.btn_cancelar.config(state="disabled")
+        self.btn_processar.config(state="normal")
+        self.update_bolinha("red")
+        self.label_tempo_estimado.config(text="Tempo estimado restante: N/A")
 
-        except Exception as e:
-            self.log(f"Erro durante processamento: {e}")
-            messagebox.showerror("Erro", f"Erro durante o processamento:\n{e}")
+class RelatorioProgresso:
+    """
+    Escreve o progresso do modo linha de comando no terminal ou em um arquivo,
+    no máximo uma vez a cada `intervalo` segundos.
+    """
 
-        finally:
-            self.salvar_resultado()
-            self.btn_pause.config(state="disabled")
-            self.btn_cancelar.config(state="disabled")
-            self.btn_processar.config(state="normal")
-            self.update_bolinha("red")
-            self.log("Processamento finalizado.")
-            self.label_tempo_estimado.config(text="Tempo estimado restante: N/A")
+    def __init__(self, destino=None, intervalo=5.0):
+        self.destino = destino
+        self.intervalo = intervalo
+        self._ultimo = 0.0
 
-    def atualizar_tempo_estimado(self):
-        if self.processed_lines == 0:
+    def __call__(self, processados, total, restante=None, forcar=False):
+        agora = time.monotonic()
+        if not forcar and agora - self._ultimo < self.intervalo:
             return
-        elapsed = time.time() - self.tempo_inicio
-        linhas_restantes = self.total_lines - self.processed_lines
-        tempo_medio = elapsed / self.processed_lines
-        tempo_restante = linhas_restantes * tempo_medio
-
-        # Formatar tempo em H:M:S
-        h = int(tempo_restante // 3600)
-        m = int((tempo_restante % 3600) // 60)
-        s = int(tempo_restante % 60)
+        self._ultimo = agora
+        perc = (processados / total * 100) if total else 0.0
+        texto = f"[{time.strftime('%H:%M:%S')}] Progresso: {processados}/{total} ({perc:.1f}%)"
+        if restante is not None:
+            texto += f" - tempo restante {formatar_tempo(restante)}"
+        if self.destino:
+            with open(self.destino, "w", encoding="utf-8") as f:
+                f.write(texto + "\n")
+        else:
+            print(texto, flush=True)
 
-        self.label_tempo_estimado.config(text=f"Tempo estimado restante: {h:02d}:{m:02d}:{s:02d}")
-        self.update()
 
-    def salvar_resultado(self):
-        formato = self.configs.get("formato_saida", "xlsx").lower()
-        output_path = self.configs.get("output", DEFAULT_CONFIGS["output"])
-        if not output_path:
-            output_path = DEFAULT_CONFIGS["output"]
-
-        # Ajusta extensão de acordo com formato escolhido
-        if formato == "xlsx" and not output_path.lower().endswith(".xlsx"):
-            output_path += ".xlsx"
-        elif formato == "csv" and not output_path.lower().endswith(".csv"):
-            output_path += ".csv"
-        elif formato == "json" and not output_path.lower().endswith(".json"):
-            output_path += ".json"
-        elif formato == "sql" and not (output_path.lower().endswith(".db") or output_path.lower().endswith(".sqlite") or output_path.lower().endswith(".sql")):
-            output_path += ".db"  # extensão padrão para sqlite
+def main(argv=None):
+    """
+    Modo linha de comando (sem interface gráfica), para servidores e agendamentos (cron).
+    Parte das configurações do .conf e sobrescreve com as opções informadas.
+    """
+    parser = argparse.ArgumentParser(description="Geocodificação reversa com dados do IBGE (sem interface).")
+    parser.add_argument("-i", "--entrada", required=True, nargs="+",
+                        help="arquivo(s) CSV/XLSX/Parquet/Feather com colunas latitude e longitude, ou uma pasta; "
+                             "vários arquivos são processados numa fila com caches compartilhados")
+    parser.add_argument("-o", "--saida", help="arquivo de saída (a extensão segue o formato); na fila, a pasta de saída")
+    parser.add_argument("--paralelos", type=int, help="arquivos da fila processados ao mesmo tempo")
+    parser.add_argument("-f", "--formato", choices=FORMATOS_SAIDA, help="formato de saída")
+    parser.add_argument("--modo", choices=["nominatim", "offline"], help="modo de geocodificação")
+    parser.add_argument("--taxa", type=float, help="requisições por segundo")
+    parser.add_argument("--rajada", type=int, help="requisições seguidas permitidas")
+    parser.add_argument("--workers", type=int, help="requisições simultâneas")
+    parser.add_argument("--timeout", type=float, help="timeout das requisições ao Nominatim (segundos)")
+    parser.add_argument("--retentativas", type=int, help="rodadas de novas tentativas para coordenadas com falha")
+    parser.add_argument("--streaming", action="store_true", help="lê e grava o arquivo em partes")
+    parser.add_argument("--ordem-espacial", action="store_true", help="geocodifica na ordem da curva de Hilbert")
+    parser.add_argument("--reuso-celula", type=int, metavar="CASAS",
+                        help="reaproveita o município resolvido na mesma célula (casas decimais)")
+    parser.add_argument("--validacao", choices=["marcar", "rejeitar", "desligada"],
+                        help="coordenadas inválidas ou fora do Brasil: marca na saída (padrão), retira ou não valida")
+    parser.add_argument("--corrigir-invertidas", action="store_true",
+                        help="desinverte latitude e longitude trocadas quando o ponto invertido cai no Brasil")
+    parser.add_argument("--anterior", metavar="ARQUIVO",
+                        help="saída de uma execução anterior: só coordenadas novas ou alteradas são geocodificadas "
+                             "(na fila, a pasta das saídas anteriores)")
+    parser.add_argument("--chave", metavar="COLUNA", help="coluna que identifica as linhas no modo incremental")
+    parser.add_argument("--config", default=CONFIG_FILE, help="arquivo de configurações (padrão: .conf)")
+    parser.add_argument("--set", action="append", default=[], metavar="CHAVE=VALOR",
+                        help="sobrescreve qualquer configuração do .conf (pode repetir)")
+    parser.add_argument("--progresso", help="arquivo onde gravar o progresso (padrão: terminal)")
+    parser.add_argument("--intervalo-progresso", type=float, default=5.0, help="segundos entre relatórios")
+    parser.add_argument("--metricas", help="arquivo de métricas (.json ou texto do Prometheus)")
+    args = parser.parse_args(argv)
+
+    configs = load_configs(args.config)
+    for item in args.set:
+        chave, _, valor = item.partition("=")
+        configs[chave.strip()] = valor.strip()
+    entradas = listar_entradas(args.entrada)
+    fila = len(entradas) > 1 or any(os.path.isdir(caminho) for caminho in args.entrada)
+    configs["input_csv"] = ";".join(entradas)
+    opcoes = {
+        "output": args.saida,
+        "formato_saida": args.formato,
+        "modo_geocodificacao": args.modo,
+        "requisicoes_por_segundo": args.taxa,
+        "rajada": args.rajada,
+        "workers": args.workers,
+        "timeout_segundos": args.timeout,
+        "retentativas": args.retentativas,
+        "modo_streaming": "1" if args.streaming else None,
+        "ordem_espacial": "1" if args.ordem_espacial else None,
+        "reuso_celula_casas": args.reuso_celula,
+        "validacao_coordenadas": args.validacao,
+        "corrigir_invertidas": "1" if args.corrigir_invertidas else None,
+        "saida_anterior": args.anterior,
+        "chave_incremental": args.chave,
+        "metricas_arquivo": args.metricas,
+        "trabalhos_paralelos": args.paralelos,
+    }
+    for chave, valor in opcoes.items():
+        if valor is not None:
+            configs[chave] = str(valor)
+
+    relatorio = RelatorioProgresso(args.progresso, args.intervalo_progresso)
+    callbacks = dict(
+        ao_log=lambda msg: print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True),
+        ao_progresso=relatorio,
+        ao_erro=lambda msg: print(f"[ERRO] {msg}", file=sys.stderr, flush=True),
+    )
+    if fila:
+        if args.saida:
+            os.makedirs(args.saida, exist_ok=True)
+        paralelos = int(configs.get("trabalhos_paralelos") or 1)
+        motor = FilaProcessamento(configs, entradas, args.saida, paralelos, **callbacks)
+    else:
+        motor = MotorGeocodificacao(configs, **callbacks)
+
+    # O motor roda em outra thread para que Ctrl+C cancele e grave o checkpoint
+    resultado = {}
+    thread = threading.Thread(target=lambda: resultado.update(concluido=motor.executar()), daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(0.5)
+    except KeyboardInterrupt:
+        print("Cancelando... aguardando gravação do checkpoint.", file=sys.stderr, flush=True)
+        motor.cancel_flag.set()
+        thread.join()
 
-        try:
-            if formato == "xlsx":
-                self.df.to_excel(output_path, index=False)
-            elif formato == "csv":
-                self.df.to_csv(output_path, index=False)
-            elif formato == "json":
-                self.df.to_json(output_path, orient="records", force_ascii=False, indent=2)
-            elif formato == "sql":
-                # Salvar em banco SQLite simples
-                conn = sqlite3.connect(output_path)
-                self.df.to_sql("dados_geocodificacao", conn, if_exists="replace", index=False)
-                conn.close()
-            else:
-                # padrão xlsx
-                self.df.to_excel(output_path, index=False)
+    if motor.total_lines:
+        relatorio(motor.processed_lines, motor.total_lines, forcar=True)
+    return 0 if resultado.get("concluido") else 1
 
-            self.log(f"Arquivo salvo em: {output_path}")
-        except Exception as e:
-            self.log(f"Erro ao salvar arquivo: {e}")
-            messagebox.showerror("Erro", f"Erro ao salvar arquivo:\n{e}")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main())
+    if tk is None:
+        sys.exit("A interface gráfica precisa do Tk (tkinter); use a linha de comando: python geoapp.py --help")
     app = App()
     app.mainloop()
-
-
-
-
-